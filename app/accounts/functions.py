@@ -1,55 +1,94 @@
 """
 This file contains all the functions and decorators used in the accounts app.
 """
+import io
 import logging
-import xml.etree.ElementTree as ET
+import threading
+import time
 import json
-from datetime import timedelta, datetime
+from collections import defaultdict
+from datetime import date, timedelta, datetime, timezone as dt_timezone
 from urllib.parse import urlparse
+from zoneinfo import ZoneInfo
 
 import django.contrib.auth
 from functools import wraps
 
-import pytz
 import requests
+import stripe
 from decouple import config
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.files.base import ContentFile
 from django.core.mail import send_mail
 from django.core.cache import cache
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.db.models import Q
-from django.shortcuts import get_object_or_404
 from django.template.loader import get_template
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.utils.html import strip_tags
 from redis import Redis
 from requests import RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from rest_framework import status
 from rest_framework.response import Response
 from rq import Queue
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from allauth.account.models import EmailAddress
+from lxml import etree
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
 
-from accounts.constants import COMPLETE, ADMIN, PAID, UNPAID, CANCELED
+from accounts.constants import COMPLETE, CANCELED, PAID, UNPAID
 from accounts.models import (Reservation, Discount, GoogleOAuthCredentials,
                              UserAlloggiatiWeb, TokenInfoAlloggiatiWeb,
-                             DmsPugliaXml, Structure)
+                             DmsPugliaXml, Structure, Room, RoomImage)
 from accounts.serializers import ReservationSerializer
 from config.settings.base import (TWILIO_AUTH_TOKEN, TWILIO_ACCOUNT_SID,
-                                  ALLOGGIATI_WEB_URL, TWILIO_NUMBER, REDIS_BACKEND, OWNER_PHONE_NUMBER)
+                                  ALLOGGIATI_WEB_URL, TWILIO_NUMBER, REDIS_BACKEND, OWNER_PHONE_NUMBER,
+                                  PROPERTY_TIME_ZONE)
 
 User = django.contrib.auth.get_user_model()
 EMAIL = config('EMAIL_HOST_USER', '')
-SERVICE_CACHE_KEY = 'google_calendar_service'
 CREDENTIALS_CACHE_KEY = 'google_calendar_credentials'
 CACHE_TIMEOUT = 3600  # One hour
+SERVICE_EXPIRY_MARGIN = 60  # Seconds before the token expiry when the memoized credentials are refreshed
+SOAP_NAMESPACE = 'http://www.w3.org/2003/05/soap-envelope'
+SOAP_NAMESPACES = {
+    'soap': SOAP_NAMESPACE,
+    'all': 'AlloggiatiService'
+}
+XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
+# Compiled once at import, looks up the <movimento> element of a given date in a DMS Puglia XML
+FIND_MOVIMENTO_BY_DATA = etree.XPath('./movimento[@data = $data]')
+FREEBUSY_MAX_CALENDARS = 50  # Maximum number of calendars accepted by a single freebusy query
+GOOGLE_BATCH_MAX_REQUESTS = 50  # Maximum number of calls sent in a single Google API batch request
+BUSY_DATES_CACHE_TIMEOUT = 180  # Three minutes, the cache is also busted when the calendars are changed
+BUSY_DATES_REFRESH_MIN_INTERVAL = 60  # Rooms just changed are refreshed in the background every minute
+BUSY_DATES_REFRESH_MAX_INTERVAL = 3600  # Rooms without recent activity are refreshed at most once an hour
+BUSY_DATES_REFRESH_MONTHS = 2  # The current and the next month are kept warm
+BUSY_DATES_REFRESH_MARKER_KEY = 'busy_days_refreshed:{room_id}'  # Set until the room is due for a refresh
+PROPERTY_TZ = ZoneInfo(PROPERTY_TIME_ZONE)  # The busy intervals are turned into days of the structures
+EMAIL_VERIFIED_CACHE_KEY = 'email_verified:{user_id}'  # Set once a user is known to have a verified email
+EMAIL_VERIFIED_CACHE_TIMEOUT = 300  # Five minutes, bounds how long a removed verified email is still accepted
 logger = logging.getLogger(__name__)
 
+# Keep-alive session for the Alloggiati Web SOAP service, so the TCP/TLS handshake is paid once per worker.
+# POST is not in the retried methods, so only the failures that happen before the request is sent are retried
+SOAP_SESSION = requests.Session()
+SOAP_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10,
+                                           max_retries=Retry(total=3, backoff_factor=0.3)))
+
+# Keep-alive HTTP client shared by the Twilio clients, the connections to the Twilio API are reused across
+# messages and threads (the self check-in reminders are sent from a thread pool)
+TWILIO_HTTP_POOL_SIZE = 16
+TWILIO_HTTP_CLIENT = TwilioHttpClient(pool_connections=True)
+TWILIO_HTTP_CLIENT.session.mount('https://', HTTPAdapter(pool_maxsize=TWILIO_HTTP_POOL_SIZE))
+
 
 #####################################################################################
 # DECORATORS #
@@ -69,10 +108,14 @@ def is_active(view_func):
             return Response({"Error": "Your account is not active or authenticated."},
                             status=status.HTTP_403_FORBIDDEN)
 
-        # Check if the email is verified
-        if not EmailAddress.objects.filter(user=user, verified=True).exists():
-            return Response({"Error": "Your email is not verified."},
-                            status=status.HTTP_403_FORBIDDEN)
+        # Check if the email is verified, the authenticated user is already loaded but its email addresses aren't.
+        # Only a verified email is cached, so a user who just confirmed the email isn't kept waiting
+        email_verified_key = EMAIL_VERIFIED_CACHE_KEY.format(user_id=user.id)
+        if not cache.get(email_verified_key):
+            if not EmailAddress.objects.filter(user=user, verified=True).exists():
+                return Response({"Error": "Your email is not verified."},
+                                status=status.HTTP_403_FORBIDDEN)
+            cache.set(email_verified_key, True, EMAIL_VERIFIED_CACHE_TIMEOUT)
 
         # Check if the user's data completion status is COMPLETE
         if user.status != COMPLETE:
@@ -87,22 +130,6 @@ def is_active(view_func):
     return decorator
 
 
-def is_admin(view_func):
-    """
-    Decorator to check if user has the status type of ADMIN
-    """
-
-    @wraps(view_func)
-    def decorator(request, *args, **kwargs):
-        user = request.user
-        if user.type == ADMIN:
-            return view_func(request, *args, **kwargs)
-        return Response({"Error": "Your account is not an admin account"},
-                        status=status.HTTP_403_FORBIDDEN)
-
-    return decorator
-
-
 #####################################################################################
 # FUNCTIONS #
 #####################################################################################
@@ -148,7 +175,8 @@ class WhatsAppService:
     def __init__(self):
         self.client = Client(
             TWILIO_ACCOUNT_SID,
-            TWILIO_AUTH_TOKEN
+            TWILIO_AUTH_TOKEN,
+            http_client=TWILIO_HTTP_CLIENT
         )
         self.from_whatsapp_number = TWILIO_NUMBER
         self.messaging_service_sid = 'MG7bc471ed29f87a3fce5bc75c0da53aab'
@@ -307,39 +335,77 @@ def send_cancel_reservation_whatsapp_message(reservation):
 def handle_checkout_session_completed(session):
     """
     Manage the checkout session completed event.
+    The reservation is marked as paid and returned, the Google Calendar event and the confirmation emails
+    are handled by the complete_paid_reservation task. None is returned if the reservation can't be updated.
+    A session can be paid after its unpaid reservation was canceled by the 10-minute timeout:
+    the reservation is booked again if its dates are still free, otherwise the payment is refunded
+    and the reservation is returned still CANCELED.
     """
     try:
         # Retrieve the session ID
         session_id = session['id']
 
-        # Find the reservation by payment intent ID
-        reservation = get_object_or_404(Reservation, payment_intent_id=session_id)
+        try:
+            with transaction.atomic():
+                # Find the reservation by payment intent ID
+                reservation = Reservation.objects.select_for_update().get(payment_intent_id=session_id)
+                was_canceled = reservation.status == CANCELED
+
+                # Update the payment intent ID and the reservation status to PAID.
+                # The exclusion constraint rejects a canceled reservation whose dates were booked again
+                reservation.payment_intent_id = session['payment_intent']
+                reservation.status = PAID
+                reservation.save(update_fields=['payment_intent_id', 'status'])
+
+        except IntegrityError:
+            logger.error(f"Reservation with checkout session {session_id} was paid after being canceled "
+                         f"and its dates were booked again, the payment {session['payment_intent']} is refunded")
+            refund_payment(session['payment_intent'])
+            # Keep the payment intent on the canceled reservation to trace the refund
+            reservation = Reservation.objects.get(payment_intent_id=session_id)
+            reservation.payment_intent_id = session['payment_intent']
+            reservation.save(update_fields=['payment_intent_id'])
+            return reservation
+
+        if was_canceled:
+            logger.warning(f"Reservation {reservation.id} was paid after being canceled, its dates were still free "
+                           f"and it is booked again")
+        return reservation
 
-        # Update the payment intent ID
-        reservation.payment_intent_id = session['payment_intent']
+    except Reservation.DoesNotExist:
+        logger.error("Reservation not found")
+        return None
+    except Exception as e:
+        logger.error(f"Error in handle_checkout_session_completed: {str(e)}")
+        return None
 
-        # Add the reservation to Google Calendar
-        service = get_google_calendar_service()
-        add_reservation_to_google_calendars(service, reservation)
 
-        # Update the reservation status to PAID
-        reservation.status = PAID
-        reservation.save()
+def refund_payment(payment_intent_id):
+    """
+    Refund in full a payment that can't be turned into a reservation.
+    The idempotency key makes a retry of the webhook refund the payment only once.
+    """
+    refund = stripe.Refund.create(payment_intent=payment_intent_id,
+                                  idempotency_key=f"refund-{payment_intent_id}")
+    logger.info(f"Payment {payment_intent_id} refunded with refund {refund.id}")
+    return refund
 
-        # Send a payment confirmation email
-        send_payment_confirmation_email(reservation)
 
-        # Send a self-checkin email
-        send_confirmation_checkout_session_completed(reservation)
+def complete_paid_reservation(reservation):
+    """
+    Add a paid reservation to Google Calendar and send the confirmation emails.
+    The event is only created once, so the task can be retried, the emails are sent after the event
+    and don't raise, so a retry doesn't send them twice.
+    """
+    if not reservation.event_id:
+        service = get_google_calendar_service()
+        add_reservation_to_google_calendars(service, reservation)
 
-        return Response({'status': 'success'}, status=status.HTTP_200_OK)
+    # Send a payment confirmation email
+    send_payment_confirmation_email(reservation)
 
-    except Reservation.DoesNotExist:
-        logger.error("Reservation not found")
-        return Response({"error": "Reservation not found"}, status=status.HTTP_404_NOT_FOUND)
-    except Exception as e:
-        logger.error(f"Error in handle_checkout_session_completed: {str(e)}")
-        return Response({'status': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    # Send a self-checkin email
+    send_confirmation_checkout_session_completed(reservation)
 
 
 def send_payment_confirmation_email(reservation):
@@ -479,39 +545,32 @@ def send_self_checkin_whatsapp_message(reservation):
         return None
 
 
-def cancel_reservation_and_remove_event(reservation):
+def delete_reservation_event(reservation):
     """
-    Cancel a reservation and remove the event from Google Calendar.
+    Remove the Google Calendar event of a canceled reservation.
+    An event that is already gone (404 or 410 from Google) counts as removed, so the removal can be retried.
     """
-    try:
-        service = get_google_calendar_service()
-
-        if reservation.event_id:
-            # Try to delete the event from the calendar associated with the reservation of django db
-            service.events().delete(calendarId=reservation.room.calendar_id, eventId=reservation.event_id).execute()
-            logger.info(f"Event {reservation.event_id} deleted from calendar {reservation.room.calendar_id}")
+    if not reservation.event_id:
+        logger.warning(f"No event_id found for reservation {reservation.id}")
+        return
 
-            # Update the reservation status to CANCELED
-            reservation.status = CANCELED
-            reservation.save()
+    service = get_google_calendar_service()
+    try:
+        # Delete the event from the calendar associated with the reservation of django db
+        service.events().delete(calendarId=reservation.room.calendar_id, eventId=reservation.event_id).execute()
+        logger.info(f"Event {reservation.event_id} deleted from calendar {reservation.room.calendar_id}")
+    except HttpError as e:
+        if e.resp.status not in (404, 410):
+            raise
+        logger.info(f"Event {reservation.event_id} already deleted from calendar {reservation.room.calendar_id}")
 
-            # Send a cancellation confirmation email
-            send_cancel_reservation_email(reservation)
-            send_cancel_reservation_whatsapp_message(reservation)
-        else:
-            logger.error("No event_id found for this reservation.")
-            raise Exception("No event_id found for this reservation.")
-    except GoogleOAuthCredentials.DoesNotExist:
-        logger.error('Google Calendar credentials not found.')
-        raise Exception('Google Calendar credentials not found.')
-    except Exception as e:
-        logger.error(f"Failed to remove event from Google Calendar: {str(e)}")
-        raise Exception(f"Failed to remove event from Google Calendar: {str(e)}")
+    invalidate_busy_dates_cache(reservation.room, reservation.check_in, reservation.check_out)
 
 
 def calculate_total_cost(reservation):
     """
-    Calculate the total cost for a reservation
+    Calculate the total cost for a reservation.
+    The cost of the nights is also stored as base_cost, so discounts can be applied without recomputing it.
     """
     # Calculate the number of nights
     number_of_nights = (reservation.check_out - reservation.check_in).days
@@ -519,21 +578,77 @@ def calculate_total_cost(reservation):
     # Calculate the total cost
     total_cost = number_of_nights * reservation.room.cost_per_night
 
-    # Update the total cost in the reservation
+    # Update the base and total cost in the reservation
+    reservation.base_cost = total_cost
     reservation.total_cost = total_cost
-    reservation.save()
+    # A new reservation is inserted with all its columns, an existing one only has the costs updated
+    reservation.save(update_fields=None if reservation._state.adding else ['base_cost', 'total_cost'])
 
     logger.debug(f"Total cost calculated for reservation {reservation.id}: {total_cost}")
     return total_cost
 
 
-def calculate_discount(reservation):
+def build_line_items(room, image_url):
+    """
+    Build the Stripe Checkout line items for a reservation of the room.
+    The unit_amount is left out, it is added at checkout from the total cost, which changes with discounts.
+    """
+    return [
+        {
+            'price_data': {
+                'currency': 'eur',
+                'product_data': {
+                    'name': f'{room.name} at {room.structure.name}',
+                    'images': [image_url],
+                },
+            },
+            'quantity': 1,
+        },
+    ]
+
+
+def get_image_url(request, model, name):
+    """
+    Return the absolute URL of an image file stored by the image field of the model
+    """
+    return request.build_absolute_uri(model._meta.get_field('image').storage.url(name))
+
+
+def get_rooms_with_images(request, rooms):
     """
-    Calculate the discount for a reservation
+    Return the rooms of a queryset as dicts with the same shape as RoomSerializer, with their images.
+    The rows are read with values(), so no model instance or serializer is built for the rooms and images.
+    """
+    rooms = list(rooms.values(
+        'id', 'name', 'room_status', 'services', 'cost_per_night', 'max_people', 'structure',
+        'calendar_id', 'calendar_id_booking'
+    ))
+    room_images = RoomImage.objects.filter(room_id__in=[room['id'] for room in rooms]).order_by('id').values(
+        'id', 'image', 'alt', 'room'
+    )
+
+    images_by_room = defaultdict(list)
+    for image in room_images:
+        image['image'] = get_image_url(request, RoomImage, image['image'])
+        images_by_room[image['room']].append(image)
+
+    for room in rooms:
+        room['cost_per_night'] = str(room['cost_per_night'])
+        room['images'] = images_by_room[room['id']]
+    return rooms
+
+
+def calculate_discount(reservation, discount=None):
+    """
+    Calculate the discount for a reservation.
+    The discount is applied to the stored base_cost, so applying a coupon again doesn't compound it.
+    An already fetched discount can be passed, otherwise it is looked up by the reservation coupon.
+    The coupon and the discounted total cost are saved together.
     """
     try:
         # Retrieve the discount object
-        discount = Discount.objects.get(code=reservation.coupon_used)
+        if discount is None:
+            discount = Discount.objects.get(code=reservation.coupon_used)
 
         # Verify if the reservation dates are within the discount period
         if reservation.check_in >= discount.start_date and reservation.check_out <= discount.end_date:
@@ -542,11 +657,15 @@ def calculate_discount(reservation):
 
             # Verify if the reservation meets the minimum number of nights for the discount
             if number_of_nights >= discount.numbers_of_nights:
+                # Reservations created before base_cost existed compute it once here
+                if reservation.base_cost is None:
+                    calculate_total_cost(reservation)
+
                 # Calculate the total discount amount
-                discount_amount = reservation.total_cost * (discount.discount / 100)
+                discount_amount = reservation.base_cost * (discount.discount / 100)
                 # Apply the discount to the reservation
-                reservation.total_cost -= discount_amount
-                reservation.save()
+                reservation.total_cost = reservation.base_cost - discount_amount
+                reservation.save(update_fields=['coupon_used', 'total_cost'])
                 logger.info(f"Discount applied to reservation {reservation.id}: {discount_amount}")
                 return discount_amount
 
@@ -560,41 +679,112 @@ def calculate_discount(reservation):
 ## GETTING GOOGLE CALENDAR SERVICE ## START
 #####################################################################################
 
-def get_google_calendar_service():
+# In-process memo of the Google Calendar credentials, shared by the threads of a worker
+_credentials_memo = {'credentials': None, 'expiry': 0}
+_credentials_lock = threading.Lock()
+# Google Calendar service of each thread, its httplib2 connection can't be shared between threads
+_thread_service = threading.local()
+
+
+def get_google_calendar_credentials():
     """
-    Constructs and returns the Google Calendar service, with caching.
+    Return the Google Calendar credentials memoized in the process.
+    Shortly before their access token expires they are refreshed in place,
+    so the services built with them keep working.
     """
-    try:
-        # Try to get the service from cache
-        service = cache.get(SERVICE_CACHE_KEY)
-        if service:
-            logger.debug("Using cached Google Calendar service.")
-            return service
-
-        # Try to get credentials from cache
-        credentials = get_cached_credentials()
-        if not credentials:
-            # Get credentials from the database
-            credentials = get_credentials_from_db()
-            cache_credentials(credentials)
+    with _credentials_lock:
+        credentials = _credentials_memo['credentials']
+        if credentials is not None:
+            if time.time() < _credentials_memo['expiry'] - SERVICE_EXPIRY_MARGIN:
+                return credentials
 
-        # Refresh credentials if expired
-        if credentials.expired and credentials.refresh_token:
-            logger.debug("Credentials expired. Attempting refresh.")
-            refresh_credentials(credentials)
-            cache_credentials(credentials)
+            try:
+                logger.debug("Memoized credentials about to expire. Attempting refresh.")
+                refresh_credentials(credentials, force=True)
+                _credentials_memo['expiry'] = get_credentials_expiry_timestamp(credentials)
+                return credentials
+            except Exception as e:
+                logger.error(f"Error while refreshing Google Calendar credentials: {e}")
+                raise Exception(f"Error setting up Google Calendar service: {str(e)}")
 
-        # Build and cache the service
+        try:
+            # Try to get credentials from cache
+            credentials = get_cached_credentials()
+            if not credentials:
+                # Get credentials from the database
+                credentials = get_credentials_from_db()
+                cache_credentials(credentials)
+
+            # Refresh credentials if expired
+            if credentials.expired and credentials.refresh_token:
+                logger.debug("Credentials expired. Attempting refresh.")
+                refresh_credentials(credentials)
+                cache_credentials(credentials)
+
+            _credentials_memo['credentials'] = credentials
+            _credentials_memo['expiry'] = get_credentials_expiry_timestamp(credentials)
+            return credentials
+
+        except Exception as e:
+            logger.error(f"Error while setting up Google Calendar service: {e}")
+            raise Exception(f"Error setting up Google Calendar service: {str(e)}")
+
+
+def get_google_calendar_service():
+    """
+    Constructs and returns the Google Calendar service of the current thread.
+    The credentials are shared by the process, while each thread builds its own service once,
+    because the HTTP connection of a service is not thread-safe.
+    """
+    credentials = get_google_calendar_credentials()
+    if getattr(_thread_service, 'credentials', None) is credentials:
+        logger.debug("Using memoized Google Calendar service.")
+        return _thread_service.service
+
+    try:
         logger.debug("Building Google Calendar service...")
         service = build('calendar', 'v3', credentials=credentials)
-        cache.set(SERVICE_CACHE_KEY, service, CACHE_TIMEOUT)
-        logger.info("Google Calendar service built and cached successfully.")
-        return service
-
     except Exception as e:
         logger.error(f"Error while setting up Google Calendar service: {e}")
         raise Exception(f"Error setting up Google Calendar service: {str(e)}")
 
+    _thread_service.service = service
+    _thread_service.credentials = credentials
+    logger.info("Google Calendar service built and memoized for the current thread.")
+    return service
+
+
+def run_with_google_calendar_service(func, *args, **kwargs):
+    """
+    Call func with the Google Calendar service of the current thread as first argument.
+    Used to submit Google Calendar calls to a thread pool, so they don't use the service of the submitting thread.
+    """
+    return func(get_google_calendar_service(), *args, **kwargs)
+
+
+def get_credentials_expiry_timestamp(credentials):
+    """
+    Return the POSIX timestamp at which the credentials expire.
+    Credentials without an expiry are considered valid for CACHE_TIMEOUT seconds.
+    """
+    if credentials.expiry:
+        # google-auth stores the expiry as a naive UTC datetime
+        return credentials.expiry.replace(tzinfo=dt_timezone.utc).timestamp()
+    return time.time() + CACHE_TIMEOUT
+
+
+def invalidate_google_calendar_service():
+    """
+    Drop the memoized Google Calendar credentials and the cached ones,
+    e.g. after new credentials have been stored in the database.
+    The services of the threads are rebuilt with the new credentials on their next use.
+    """
+    with _credentials_lock:
+        _credentials_memo['credentials'] = None
+        _credentials_memo['expiry'] = 0
+    cache.delete(CREDENTIALS_CACHE_KEY)
+    logger.debug("Google Calendar service and credentials cache invalidated.")
+
 
 def cache_credentials(credentials):
     """
@@ -641,7 +831,9 @@ def get_credentials_from_db():
     Retrieve the Google Calendar credentials from the database.
     """
     try:
-        creds = GoogleOAuthCredentials.objects.get(id=1)
+        creds = GoogleOAuthCredentials.objects.only(
+            'token', 'refresh_token', 'token_uri', 'client_id', 'client_secret', 'scopes'
+        ).get(id=1)
         logger.debug("Credentials retrieved from database.")
         return Credentials(
             token=creds.token,
@@ -664,11 +856,11 @@ def update_db_token(token):
     logger.debug("Database updated with new token.")
 
 
-def refresh_credentials(credentials):
+def refresh_credentials(credentials, force=False):
     """
-    Refreshes the credentials if they have expired.
+    Refreshes the credentials if they have expired, or whenever force is set.
     """
-    if credentials.expired and credentials.refresh_token:
+    if (force or credentials.expired) and credentials.refresh_token:
         try:
             credentials.refresh(Request())
             logger.info("Access token refreshed successfully.")
@@ -687,8 +879,15 @@ def refresh_credentials(credentials):
 #####################################################################################
 
 def add_reservation_to_google_calendars(service, reservation):
+    """
+    Add the event of a paid reservation to the room calendar and store its ID in the reservation.
+    The event ID is derived from the reservation, so when a retry inserts it again Google answers 409
+    and the event created by the first attempt is kept.
+    """
+    event_id = reservation.reservation_id.hex
     try:
         event = {
+            'id': event_id,
             'summary': f"Reservation for {reservation.first_name_on_reservation} {reservation.last_name_on_reservation}",
             'description': (
                 f"Email: {reservation.email_on_reservation}\n"
@@ -719,128 +918,314 @@ def add_reservation_to_google_calendars(service, reservation):
         }
 
         # Add the event to the calendar associated with django
-        created_event = service.events().insert(calendarId=reservation.room.calendar_id, body=event).execute()
-        logger.info(f"Event created in calendar {reservation.room.calendar_id} with ID {created_event.get('id')}")
+        try:
+            service.events().insert(calendarId=reservation.room.calendar_id, body=event).execute()
+            logger.info(f"Event created in calendar {reservation.room.calendar_id} with ID {event_id}")
+        except HttpError as e:
+            if e.resp.status != 409:
+                raise
+            logger.info(f"Event {event_id} already exists in calendar {reservation.room.calendar_id}")
+        invalidate_busy_dates_cache(reservation.room, reservation.check_in, reservation.check_out)
 
         # Memorize the event ID in the reservation
-        reservation.event_id = created_event.get('id')
-        reservation.save()
+        reservation.event_id = event_id
+        reservation.save(update_fields=['event_id'])
 
-        return created_event
+        return event_id
     except Exception as e:
         logger.error(f"Failed to add reservation to Google Calendars: {str(e)}")
         raise Exception(f"Failed to add reservation to Google Calendars: {str(e)}")
 
 
+def get_date_range(start_date, end_date):
+    """
+    Return the days from start_date to end_date, both included, as date ordinals (date.toordinal()).
+    Busy dates are handled as ordinals so that no date object or string is built per day.
+    """
+    return range(start_date.toordinal(), end_date.toordinal() + 1)
+
+
 def get_busy_dates_from_reservations(room, check_in, check_out):
     busy_dates = set()
     current_time = timezone.now()
 
-    # Filter reservations that overlap with the selected dates and are not UNPAID and older than 10 minutes
+    # Filter reservations that overlap with the selected dates and are neither CANCELED
+    # nor UNPAID and older than 10 minutes
     local_reservations = Reservation.objects.filter(
         room=room,
         check_out__gte=check_in,
         check_in__lte=check_out
-    ).exclude(
+    ).exclude(status=CANCELED).exclude(
         Q(status=UNPAID) & Q(created_at__lt=(current_time - timedelta(minutes=10)))
     )
 
     # Collect the busy dates from the reservations
     for reservation in local_reservations:
-        current_date = reservation.check_in
-        while current_date < reservation.check_out:
-            busy_dates.add(current_date.strftime('%Y-%m-%d'))
-            current_date += timedelta(days=1)
+        busy_dates.update(get_date_range(reservation.check_in, reservation.check_out - timedelta(days=1)))
 
     logger.debug(f"Busy dates from reservations for room {room.name}: {busy_dates}")
     return busy_dates
 
 
-def get_busy_dates_from_calendars(service, room, check_in, check_out):
-    busy_dates = set()
-    calendar_ids = [room.calendar_id, room.calendar_id_booking]
-
-    for calendar_id in filter(None, calendar_ids):
-        try:
-            logger.debug(f"Fetching events from calendar {calendar_id}")
-            # Correctly format timeMin and timeMax
-            time_min = check_in.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-            time_max = check_out.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-
-            events_result = service.events().list(
-                calendarId=calendar_id,
-                timeMin=time_min,
-                timeMax=time_max,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-            events = events_result.get('items', [])
-            logger.debug(f"Number of events fetched from calendar {calendar_id}: {len(events)}")
-
-            for event in events:
-                logger.debug(f"Processing event ID: {event.get('id')}, Summary: {event.get('summary')}")
-
-                # Handle events with 'date' (all-day events) and 'dateTime' (events with specific times)
-                start = event['start'].get('date') or event['start'].get('dateTime')
-                end = event['end'].get('date') or event['end'].get('dateTime')
-
-                if not start or not end:
-                    logger.warning(f"Event {event.get('id')} has missing start or end time.")
-                    continue
-
-                # Parse the start and end dates
-                start_date = parse_event_date(start)
-                end_date = parse_event_date(end)
-
-                if not start_date or not end_date:
-                    logger.warning(f"Skipping event {event.get('id')} due to date parsing error.")
-                    continue
-
-                # For all-day events, the end date is exclusive
-                if 'date' in event['start']:
-                    # Adjust end_date to include the last day
-                    end_date -= timedelta(days=1)
-
-                current_date = start_date
-                while current_date <= end_date:
-                    busy_dates.add(current_date.strftime('%Y-%m-%d'))
-                    current_date += timedelta(days=1)
-
-            logger.debug(f"Busy dates from calendar {calendar_id} for room {room.name}: {busy_dates}")
-        except Exception as e:
-            logger.error(f"Error fetching events from calendar {calendar_id}: {str(e)}")
-            raise Exception(f"Error fetching events from calendar {calendar_id}: {str(e)}")
+def get_busy_dates_from_calendars(service, room, check_in, check_out, use_cache=False):
+    """
+    Obtain the busy dates on both Google Calendars of a room with a single freebusy query.
+    The calendars are read directly unless use_cache is set, the cache only knows about the changes made
+    by the app, so a booking.com reservation can be missing from it and it is only used by the read endpoints.
+    """
+    try:
+        busy_dates = get_busy_dates_for_rooms(service, [room], check_in, check_out, use_cache=use_cache)[room.id]
+    except Exception as e:
+        logger.error(f"Error fetching busy intervals for room {room.name}: {str(e)}")
+        raise Exception(f"Error fetching busy intervals for room {room.name}: {str(e)}")
 
+    logger.debug(f"Busy dates from calendars for room {room.name}: {busy_dates}")
     return busy_dates
 
 
-def parse_event_date(date_str):
+def execute_google_requests(service, http_requests):
     """
-    Parse event date string to datetime.date object.
+    Execute Google API requests, when there is more than one they are sent together in batch requests
+    of GOOGLE_BATCH_MAX_REQUESTS calls, so they share a single HTTP round trip.
+    Returns the responses in the order of the requests and raises the first error received.
     """
-    try:
-        if 'T' in date_str:
-            # DateTime format
-            return datetime.fromisoformat(date_str.replace('Z', '+00:00')).date()
+    if len(http_requests) == 1:
+        return [http_requests[0].execute()]
+
+    responses = [None] * len(http_requests)
+    errors = []
+
+    def collect_response(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
         else:
-            # Date format (all-day events)
-            return datetime.strptime(date_str, '%Y-%m-%d').date()
-    except ValueError as e:
-        logger.error(f"Error parsing date string '{date_str}': {str(e)}")
-        return None
+            responses[int(request_id)] = response
+
+    for start in range(0, len(http_requests), GOOGLE_BATCH_MAX_REQUESTS):
+        batch = service.new_batch_http_request(callback=collect_response)
+        for index in range(start, min(start + GOOGLE_BATCH_MAX_REQUESTS, len(http_requests))):
+            batch.add(http_requests[index], request_id=str(index))
+        batch.execute()
+
+    if errors:
+        raise errors[0]
+    return responses
+
+
+def query_freebusy_windows(service, windows):
+    """
+    Fetch the busy intervals of several (calendar_ids, time_min, time_max) windows with the freebusy API.
+    Each window is split in queries of FREEBUSY_MAX_CALENDARS calendars and all the queries are executed
+    together with execute_google_requests.
+    Returns, for each window, a dict mapping each calendar id to its list of busy intervals
+    ({'start': ..., 'end': ...}).
+    """
+    queries = []
+    for window_index, (calendar_ids, time_min, time_max) in enumerate(windows):
+        calendar_ids = list(dict.fromkeys(filter(None, calendar_ids)))
+        # RFC 3339 bounds, formatted once for all the queries of the window
+        time_min_str = time_min.astimezone(dt_timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        time_max_str = time_max.astimezone(dt_timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        for index in range(0, len(calendar_ids), FREEBUSY_MAX_CALENDARS):
+            chunk = calendar_ids[index:index + FREEBUSY_MAX_CALENDARS]
+            logger.debug(f"Querying freebusy for calendars {chunk} from {time_min_str} to {time_max_str}")
+            queries.append((window_index, service.freebusy().query(body={
+                'timeMin': time_min_str,
+                'timeMax': time_max_str,
+                'timeZone': PROPERTY_TIME_ZONE,
+                'items': [{'id': calendar_id} for calendar_id in chunk]
+            })))
+
+    busy_by_window = [{} for _ in windows]
+    if not queries:
+        return busy_by_window
+
+    responses = execute_google_requests(service, [query for _, query in queries])
+    for (window_index, _), response in zip(queries, responses):
+        for calendar_id, calendar in response.get('calendars', {}).items():
+            if calendar.get('errors'):
+                logger.error(f"Error fetching busy intervals from calendar {calendar_id}: {calendar['errors']}")
+                raise Exception(f"Error fetching busy intervals from calendar {calendar_id}: {calendar['errors']}")
+            busy_by_window[window_index][calendar_id] = calendar.get('busy', [])
+
+    return busy_by_window
+
+
+def query_freebusy(service, calendar_ids, time_min, time_max):
+    """
+    Fetch the busy intervals of the given calendars with the Google Calendar freebusy API.
+    Returns a dict mapping each calendar id to its list of busy intervals ({'start': ..., 'end': ...}).
+    """
+    return query_freebusy_windows(service, [(calendar_ids, time_min, time_max)])[0]
+
+
+def busy_intervals_to_dates(intervals):
+    """
+    Convert freebusy intervals to the set of busy dates, as date ordinals.
+    The instants are converted to the time zone of the structures first, so an all-day event,
+    which starts at the local midnight (e.g. 23:00Z the day before), only occupies its own days.
+    The end of an interval is exclusive, so an interval ending at midnight does not occupy the next day.
+    """
+    busy_dates = set()
+    for interval in intervals:
+        start_date = datetime.fromisoformat(interval['start']).astimezone(PROPERTY_TZ).date()
+        end = datetime.fromisoformat(interval['end']).astimezone(PROPERTY_TZ)
+        end_date = (end - timedelta(microseconds=1)).date()
+        busy_dates.update(get_date_range(start_date, end_date))
+
+    return busy_dates
+
+
+def busy_dates_to_intervals(busy_dates):
+    """
+    Group busy dates (date ordinals) into the minimal list of {'start': ..., 'end': ...} intervals,
+    the bounds are 'YYYY-MM-DD' dates and the end is excluded, like in the freebusy API.
+    """
+    intervals = []
+    start = end = None
+    for day in sorted(busy_dates):
+        if start is not None and day == end + 1:
+            end = day
+            continue
+        if start is not None:
+            intervals.append({'start': date.fromordinal(start).isoformat(),
+                              'end': date.fromordinal(end + 1).isoformat()})
+        start = end = day
+
+    if start is not None:
+        intervals.append({'start': date.fromordinal(start).isoformat(),
+                          'end': date.fromordinal(end + 1).isoformat()})
+    return intervals
+
+
+def get_month_starts(start, end):
+    """
+    Return the first day of every month overlapped by the half-open range [start, end).
+    The bounds are dates, or the midnights the views build from the requested dates, whose date is used as is.
+    """
+    start = start.date() if isinstance(start, datetime) else start
+    end = (end - timedelta(microseconds=1)).date() if isinstance(end, datetime) else end - timedelta(days=1)
+
+    month_starts = []
+    month = start.replace(day=1)
+    while month <= end:
+        month_starts.append(month)
+        month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return month_starts
+
+
+def get_busy_dates_cache_key(calendar_id, month):
+    """
+    Return the cache key of the busy dates of a calendar for the given month.
+    """
+    return f"busy_days:{calendar_id}:{month.strftime('%Y%m')}"
+
+
+def get_busy_dates_for_rooms(service, rooms, check_in, check_out, use_cache=True):
+    """
+    Obtain the busy dates on the Google Calendars of several rooms with batched freebusy queries.
+    The busy dates are cached per calendar and month, whole months are always fetched so that
+    the following searches in the same months are served from the cache.
+    With use_cache=False the cache is not read, the fetched months are still stored in it.
+    Returns a dict mapping each room id to its set of busy dates (date ordinals).
+    """
+    calendar_ids = list(dict.fromkeys(
+        calendar_id for room in rooms for calendar_id in (room.calendar_id, room.calendar_id_booking) if calendar_id
+    ))
+    month_starts = get_month_starts(check_in, check_out)
+    cache_keys = {
+        (calendar_id, month): get_busy_dates_cache_key(calendar_id, month)
+        for calendar_id in calendar_ids for month in month_starts
+    }
+    cached_busy_dates = cache.get_many(cache_keys.values()) if use_cache else {}
+
+    busy_dates_by_calendar = {calendar_id: set() for calendar_id in calendar_ids}
+    # Whole months missing from the cache, fetched together at the end
+    missing_windows = []
+    for month in month_starts:
+        missing_calendar_ids = []
+        for calendar_id in calendar_ids:
+            cache_key = cache_keys[(calendar_id, month)]
+            if cache_key in cached_busy_dates:
+                busy_dates_by_calendar[calendar_id].update(cached_busy_dates[cache_key])
+            else:
+                missing_calendar_ids.append(calendar_id)
+
+        if missing_calendar_ids:
+            # The month is fetched from and to the local midnights, so its first and last days are whole
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            time_min = datetime(month.year, month.month, 1, tzinfo=PROPERTY_TZ)
+            time_max = datetime(next_month.year, next_month.month, 1, tzinfo=PROPERTY_TZ)
+            missing_windows.append((month, missing_calendar_ids, time_min, time_max))
+
+    busy_dates_to_cache = {}
+    busy_by_window = query_freebusy_windows(
+        service,
+        [(missing_calendar_ids, time_min, time_max) for _, missing_calendar_ids, time_min, time_max in missing_windows]
+    )
+    for (month, missing_calendar_ids, _, _), busy_by_calendar in zip(missing_windows, busy_by_window):
+        for calendar_id in missing_calendar_ids:
+            busy_dates = busy_intervals_to_dates(busy_by_calendar.get(calendar_id, []))
+            busy_dates_to_cache[cache_keys[(calendar_id, month)]] = busy_dates
+            busy_dates_by_calendar[calendar_id].update(busy_dates)
+
+    if busy_dates_to_cache:
+        cache.set_many(busy_dates_to_cache, BUSY_DATES_CACHE_TIMEOUT)
+
+    busy_dates_by_room = {}
+    for room in rooms:
+        busy_dates = set()
+        for calendar_id in filter(None, (room.calendar_id, room.calendar_id_booking)):
+            busy_dates.update(busy_dates_by_calendar[calendar_id])
+        busy_dates_by_room[room.id] = busy_dates
+
+    return busy_dates_by_room
+
+
+def invalidate_busy_dates_cache(room, check_in, check_out):
+    """
+    Drop the cached busy dates of the room calendars for the months overlapped by the given dates.
+    """
+    cache.delete_many([
+        get_busy_dates_cache_key(calendar_id, month)
+        for calendar_id in filter(None, (room.calendar_id, room.calendar_id_booking))
+        for month in get_month_starts(check_in, check_out)
+    ] + [BUSY_DATES_REFRESH_MARKER_KEY.format(room_id=room.pk)])
+    # Mark the room as recently changed, so its busy dates are refreshed more often
+    Room.objects.filter(pk=room.pk).update(last_calendar_change_at=timezone.now())
+    logger.debug(f"Busy dates cache invalidated for room {room.name}")
+
+
+def get_busy_dates_refresh_interval(last_activity_at, now):
+    """
+    Return the number of seconds between two background refreshes of the busy dates of a room.
+    The interval is twice the time elapsed since the last activity on the room,
+    between BUSY_DATES_REFRESH_MIN_INTERVAL and BUSY_DATES_REFRESH_MAX_INTERVAL.
+    """
+    if last_activity_at is None:
+        return BUSY_DATES_REFRESH_MAX_INTERVAL
+    elapsed = (now - last_activity_at).total_seconds()
+    return int(min(BUSY_DATES_REFRESH_MAX_INTERVAL, max(BUSY_DATES_REFRESH_MIN_INTERVAL, 2 * elapsed)))
 
 
 def get_combined_busy_dates(room, check_in, check_out, service):
     """
     Obtain the combined busy dates from the reservations and Google Calendar.
+    Used by the read endpoints, the calendar busy dates can come from the cache.
     """
     try:
         # Obtain the busy dates from the reservations
         busy_dates = get_busy_dates_from_reservations(room, check_in, check_out)
 
+        # Skip the Google Calendar call when the reservations already cover the whole stay
+        stay_dates = get_date_range(check_in.date(), check_out.date() - timedelta(days=1))
+        if busy_dates.issuperset(stay_dates):
+            logger.debug(f"Room {room.name} fully booked by reservations, skipping Google Calendar.")
+            return busy_dates
+
         # Obtain the busy dates from the Google Calendar
         if service:
-            busy_dates_calendar = get_busy_dates_from_calendars(service, room, check_in, check_out)
+            busy_dates_calendar = get_busy_dates_from_calendars(service, room, check_in, check_out, use_cache=True)
             busy_dates.update(busy_dates_calendar)
         else:
             logger.error("Google Calendar service is unavailable.")
@@ -855,17 +1240,13 @@ def get_combined_busy_dates(room, check_in, check_out, service):
 
 def is_room_available(busy_dates, check_in, check_out):
     """
-    Check if a room is available given a set of busy dates.
-    """
-    check_in_date = check_in.date()
-    check_out_date = check_out.date() - timedelta(days=1)  # Exclude the check-out date
-    current_date = check_in_date
-    while current_date <= check_out_date:
-        date_str = current_date.strftime('%Y-%m-%d')
-        if date_str in busy_dates:
-            logger.debug(f"Room not available on {date_str}")
-            return False
-        current_date += timedelta(days=1)
+    Check if a room is available given a set of busy dates (date ordinals).
+    """
+    # Exclude the check-out date
+    stay_dates = get_date_range(check_in.date(), check_out.date() - timedelta(days=1))
+    if not busy_dates.isdisjoint(stay_dates):
+        logger.debug(f"Room not available for dates {check_in.date()} to {check_out.date()}")
+        return False
     logger.debug("Room is available for the selected dates.")
     return True
 
@@ -876,23 +1257,20 @@ def build_soap_envelope(action, body_content):
     """
     Make a SOAP request to the Alloggiati Web service.
     """
-    envelope = ET.Element('{http://www.w3.org/2003/05/soap-envelope}Envelope', attrib={
-        'xmlns:soap': 'http://www.w3.org/2003/05/soap-envelope',
-        'xmlns:all': 'AlloggiatiService'
-    })
-    ET.SubElement(envelope, '{http://www.w3.org/2003/05/soap-envelope}Header')
-    body = ET.SubElement(envelope, '{http://www.w3.org/2003/05/soap-envelope}Body')
-    action_element = ET.SubElement(body, f'{action}')
+    envelope = etree.Element(f'{{{SOAP_NAMESPACE}}}Envelope', nsmap=SOAP_NAMESPACES)
+    etree.SubElement(envelope, f'{{{SOAP_NAMESPACE}}}Header')
+    body = etree.SubElement(envelope, f'{{{SOAP_NAMESPACE}}}Body')
+    action_element = etree.SubElement(body, action)
 
     for key, value in body_content.items():
         if isinstance(value, tuple):
-            sub_element = ET.SubElement(action_element, value[0])
+            sub_element = etree.SubElement(action_element, value[0])
             sub_element.text = value[1]
         else:
             # Add the value directly to the action element
             action_element.append(value)
 
-    return ET.tostring(envelope, encoding='utf-8', method='xml')
+    return etree.tostring(envelope, encoding='utf-8')
 
 
 def send_soap_request(xml_request):
@@ -901,7 +1279,7 @@ def send_soap_request(xml_request):
     """
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
     try:
-        response = requests.post(ALLOGGIATI_WEB_URL, data=xml_request, headers=headers, timeout=10)
+        response = SOAP_SESSION.post(ALLOGGIATI_WEB_URL, data=xml_request, headers=headers, timeout=10)
         response.raise_for_status()
         logger.debug("SOAP request sent successfully.")
         return response.content
@@ -913,35 +1291,27 @@ def send_soap_request(xml_request):
 def parse_soap_response(xml_response, action_namespace, expected_fields):
     """
     Analize the SOAP response from the Alloggiati Web service.
+    The response is streamed and only the text of the expected elements is kept.
     """
-    namespaces = {
-        'soap': 'http://www.w3.org/2003/05/soap-envelope',
-        'all': 'AlloggiatiService'
-    }
+    namespace = SOAP_NAMESPACES[action_namespace]
+    tags = {f'{{{namespace}}}{field}': field for field in ['esito', *expected_fields]}
 
-    root = ET.fromstring(xml_response)
-
-    # Find the esito element
-    esito_element = root.find(f'.//{action_namespace}:esito', namespaces)
+    # Keep the text of the first occurrence of each element, clearing it once read
+    values = {}
+    for _, element in etree.iterparse(io.BytesIO(xml_response), events=('end',), tag=list(tags),
+                                      resolve_entities=False):
+        values.setdefault(tags[element.tag], element.text.strip() if element.text else None)
+        element.clear()
 
     # If esito is not True, raise a ValidationError
-    if esito_element is None or esito_element.text.strip().lower() != 'true':
-        error_details = {}
-        for field in expected_fields:
-            element = root.find(f'.//{action_namespace}:{field}', namespaces)
-            if element is not None and element.text:
-                error_details[field] = element.text.strip()
-            else:
-                error_details[field] = "Missing or empty field"
-
+    esito = values.get('esito')
+    if esito is None or esito.lower() != 'true':
+        error_details = {field: values.get(field) or "Missing or empty field" for field in expected_fields}
         logger.error(f"SOAP Error: {error_details}")
         raise ValidationError("SOAP Error", error_details)
 
     # Collect the expected fields from the response
-    result = {}
-    for field in expected_fields:
-        element = root.find(f'.//{action_namespace}:{field}', namespaces)
-        result[field] = element.text.strip() if element is not None and element.text else None
+    result = {field: values.get(field) for field in expected_fields}
 
     logger.debug(f"SOAP response parsed successfully: {result}")
     return result
@@ -1008,9 +1378,9 @@ def validate_elenco_schedine(structure_id, elenco_schedine):
         user_info = UserAlloggiatiWeb.objects.get(structure__id=structure_id)
         token_info = get_or_create_token(structure_id)
 
-        elenco_subelement = ET.Element('{AlloggiatiService}ElencoSchedine')
+        elenco_subelement = etree.Element('{AlloggiatiService}ElencoSchedine')
         for schedina in elenco_schedine:
-            schedina_element = ET.SubElement(elenco_subelement, '{AlloggiatiService}string')
+            schedina_element = etree.SubElement(elenco_subelement, '{AlloggiatiService}string')
             schedina_element.text = schedina
 
         body_content = {
@@ -1046,6 +1416,7 @@ def validate_elenco_schedine(structure_id, elenco_schedine):
 def generate_dms_puglia_xml(data, vendor):
     """
     Generate or update a DMS Puglia XML file.
+    Returns the serialized XML as UTF-8 encoded bytes.
     """
     try:
         movimento_data = data['data']  # Should be a datetime.date object
@@ -1085,7 +1456,7 @@ def append_element_with_text(parent_el, tag, text):
     """
     Helper function to create a new XML element with text.
     """
-    el = ET.SubElement(parent_el, tag)
+    el = etree.SubElement(parent_el, tag)
     el.text = str(text) if text else ""
     return el
 
@@ -1094,9 +1465,9 @@ def append_componenti_to_arrivo(arrivo_el, componenti):
     """
     Append componenti to the <arrivo> element.
     """
-    componenti_el = ET.SubElement(arrivo_el, "componenti")
+    componenti_el = etree.SubElement(arrivo_el, "componenti")
     for componente in componenti:
-        componente_el = ET.SubElement(componenti_el, "componente")
+        componente_el = etree.SubElement(componenti_el, "componente")
         for key in ['codice_cliente_sr', 'sesso', 'cittadinanza', 'paese_residenza', 'comune_residenza',
                     'occupazione_posto_letto', 'eta']:
             append_element_with_text(componente_el, key, componente.get(key, " "))
@@ -1106,9 +1477,9 @@ def append_arrivi_to_movimento(movimento_el, arrivi):
     # Try to find an existing <arrivi> element
     arrivi_el = movimento_el.find('arrivi')
     if arrivi_el is None:
-        arrivi_el = ET.SubElement(movimento_el, "arrivi")
+        arrivi_el = etree.SubElement(movimento_el, "arrivi")
     for arrivo in arrivi:
-        arrivo_el = ET.SubElement(arrivi_el, "arrivo")
+        arrivo_el = etree.SubElement(arrivi_el, "arrivo")
         for key in ['codice_cliente_sr', 'sesso', 'cittadinanza', 'paese_residenza',
                     'comune_residenza', 'occupazione_postoletto', 'dayuse', 'tipologia_alloggiato', 'eta',
                     'durata_soggiorno']:
@@ -1128,14 +1499,11 @@ def update_existing_xml(existing_dms_instance, data, movimento_data):
     try:
         logger.debug("Updating existing XML")
         # Read and parse the existing XML content
-        existing_xml_content = existing_dms_instance.xml.read().decode('utf-8')
-
-        tree = ET.ElementTree(ET.fromstring(existing_xml_content))
-        root = tree.getroot()
+        root = etree.fromstring(existing_dms_instance.xml.read())
 
         # Find the movimento element
         movimento_data_str = movimento_data.strftime('%Y-%m-%d')
-        movimento_el = root.find(f"./movimento[@data='{movimento_data_str}']")
+        movimento_el = next(iter(FIND_MOVIMENTO_BY_DATA(root, data=movimento_data_str)), None)
 
         if movimento_el is None:
             raise ValueError(f"Movimento element with date {movimento_data_str} not found in existing XML.")
@@ -1144,7 +1512,7 @@ def update_existing_xml(existing_dms_instance, data, movimento_data):
         append_arrivi_to_movimento(movimento_el, data['arrivi'])
 
         # Save updated XML content back to the database
-        updated_xml_content = ET.tostring(root, encoding="utf-8", method="xml").decode("utf-8")
+        updated_xml_content = etree.tostring(root, encoding="utf-8", xml_declaration=True)
         save_xml_to_db(existing_dms_instance, updated_xml_content, movimento_data)
 
         return updated_xml_content
@@ -1164,22 +1532,21 @@ def create_new_xml(data, movimento_data, vendor, structure):
         movimento_data_str = movimento_data.strftime('%Y-%m-%d')
 
         # Create the root element for the new XML
-        root = ET.Element("movimenti", attrib={
-            'xmlns:xsi': "http://www.w3.org/2001/XMLSchema-instance",
-            'xsi:noNamespaceSchemaLocation': "movimentogiornaliero-0.6.xsd",
+        root = etree.Element("movimenti", attrib={
+            f'{{{XSI_NAMESPACE}}}noNamespaceSchemaLocation': "movimentogiornaliero-0.6.xsd",
             'vendor': vendor
-        })
+        }, nsmap={'xsi': XSI_NAMESPACE})
 
         # Create a new movimento element and add arrivi
-        movimento_el = ET.SubElement(root, "movimento", attrib={
+        movimento_el = etree.SubElement(root, "movimento", attrib={
             'type': data['type'],
             'data': movimento_data_str
         })
         append_arrivi_to_movimento(movimento_el, data['arrivi'])
 
         # Save new XML content to the database
-        new_xml_content = ET.tostring(root, encoding="utf-8", method="xml").decode("utf-8")
-        logger.debug(f"New XML Content (decoded): {new_xml_content}")
+        new_xml_content = etree.tostring(root, encoding="utf-8", xml_declaration=True)
+        logger.debug(f"New XML Content: {new_xml_content}")
 
         # Create the DmsPugliaXml instance with the structure and date
         dms_instance = DmsPugliaXml(structure=structure, date=movimento_data)  # Ensure date is set
@@ -1197,12 +1564,12 @@ def find_or_create_movimento(root, data, movimento_data):
     Find or create the 'movimento' element in the XML.
     """
     movimento_data_str = movimento_data.strftime('%Y-%m-%d')
-    movimento_el = root.find(f"./movimento[@data='{movimento_data_str}']")
+    movimento_el = next(iter(FIND_MOVIMENTO_BY_DATA(root, data=movimento_data_str)), None)
     if movimento_el is not None:
         return movimento_el
 
     # If movimento element does not exist, create a new one
-    return ET.SubElement(root, 'movimento', attrib={
+    return etree.SubElement(root, 'movimento', attrib={
         'type': data['type'],
         'data': movimento_data_str
     })
@@ -1211,7 +1578,7 @@ def find_or_create_movimento(root, data, movimento_data):
 @transaction.atomic
 def save_xml_to_db(dms_instance, xml_content, movimento_data):
     """
-    Save the XML content to the database inside a transaction.
+    Save the XML content (UTF-8 encoded bytes) to the database inside a transaction.
     """
     if not dms_instance.structure_id:
         raise ValueError("Missing structure_id in DmsPugliaXml instance.")
@@ -1222,13 +1589,14 @@ def save_xml_to_db(dms_instance, xml_content, movimento_data):
         relative_filename = f'dms_puglia_xml/{structure.name}_{movimento_data_str}.xml'
         logger.debug(f"Saving file: {relative_filename}")
 
-        content_file = ContentFile(xml_content.encode('utf-8'))
+        content_file = ContentFile(xml_content)
 
         # Overwrite the existing file or save a new one
         dms_instance.xml.save(relative_filename, content_file, save=False)
         dms_instance.date = movimento_data  # Set the date field
 
-        dms_instance.save()
+        # Only the file and the date change on an existing XML
+        dms_instance.save(update_fields=None if dms_instance._state.adding else ['xml', 'date'])
         logger.info(f"File saved successfully at: {dms_instance.xml.name}")
 
     except Exception as e:
@@ -0,0 +1,70 @@
+# Generated by Django 5.1 on 2026-10-15 22:46
+
+from datetime import timedelta
+
+import accounts.models
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+
+def cancel_expired_unpaid_reservations(apps, schema_editor):
+    """
+    Cancel the unpaid reservations older than 10 minutes, they no longer hold the room
+    and would otherwise prevent the creation of the exclusion constraint.
+    """
+    Reservation = apps.get_model('accounts', 'Reservation')
+    Reservation.objects.filter(
+        status='UNPAID',
+        created_at__lt=timezone.now() - timedelta(minutes=10)
+    ).update(status='CANCELED')
+
+
+def check_no_overlapping_reservations(apps, schema_editor):
+    """
+    Stop the migration if reservations that aren't canceled overlap on the same room,
+    the exclusion constraint couldn't be created. They have to be canceled or moved by hand,
+    the migration runs in a transaction so it is rolled back and can be run again after the cleanup.
+    """
+    Reservation = apps.get_model('accounts', 'Reservation')
+    active = Reservation.objects.exclude(status='CANCELED')
+    overlapping = active.filter(Exists(
+        active.filter(
+            room=OuterRef('room'), check_in__lt=OuterRef('check_out'), check_out__gt=OuterRef('check_in')
+        ).exclude(pk=OuterRef('pk'))
+    )).order_by('room_id', 'check_in').values_list('id', 'room_id', 'check_in', 'check_out', 'status')
+
+    if overlapping:
+        details = '\n'.join(
+            f"  reservation {pk}: room {room_id}, {check_in} - {check_out}, {status}"
+            for pk, room_id, check_in, check_out, status in overlapping
+        )
+        raise RuntimeError(
+            "Reservations that aren't canceled overlap on the same room, cancel or move them "
+            f"before adding the exclusion constraint:\n{details}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_alter_dmspugliaxml_unique_together'),
+    ]
+
+    operations = [
+        BtreeGistExtension(),
+        migrations.RunPython(cancel_expired_unpaid_reservations, migrations.RunPython.noop),
+        migrations.RunPython(check_no_overlapping_reservations, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='reservation',
+            name='period',
+            field=models.GeneratedField(db_persist=True, expression=accounts.models.DateRange('check_in', 'check_out', models.Value('[)')), output_field=django.contrib.postgres.fields.ranges.DateRangeField()),
+        ),
+        migrations.AddConstraint(
+            model_name='reservation',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('status', 'CANCELED'), _negated=True), expressions=[('room', '='), ('period', '&&')], name='exclude_overlapping_reservations'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-15 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_reservation_period_exclusion_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reservation',
+            name='base_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+    ]
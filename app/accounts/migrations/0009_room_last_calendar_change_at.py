@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-15 22:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_reservation_base_cost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_calendar_change_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
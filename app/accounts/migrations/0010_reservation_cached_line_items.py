@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-15 22:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_room_last_calendar_change_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reservation',
+            name='cached_line_items',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1 on 2026-10-15 22:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_reservation_cached_line_items'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='type',
+            field=models.CharField(choices=[('CUSTOMER', 'Customer'), ('ADMIN', 'Admin')], db_index=True, default='CUSTOMER', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['room', 'check_out'], name='reservation_room_check_out_idx'),
+        ),
+    ]
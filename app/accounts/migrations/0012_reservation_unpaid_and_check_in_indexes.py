@@ -0,0 +1,21 @@
+# Generated by Django 5.1 on 2026-10-15 23:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_reservation_indexes_user_type'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('status', 'UNPAID')), fields=['created_at'], name='reservation_unpaid_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['check_in'], name='reservation_check_in_idx'),
+        ),
+    ]
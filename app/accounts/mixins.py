@@ -0,0 +1,77 @@
+"""
+This file contains the mixins used by the viewsets of the accounts app.
+"""
+import hashlib
+
+from django.core.cache import cache
+from rest_framework.response import Response
+
+READ_CACHE_TIMEOUT = 300  # Five minutes, bounds the staleness of changes made outside the API (e.g. the admin)
+READ_CACHE_VERSION_KEY = 'read_cache_version:{namespace}'
+READ_CACHE_KEY = 'read_cache:{namespace}:{version}:{digest}'
+
+# Cached reads of the structures, rooms and discounts, the structures embed their rooms and images
+STRUCTURES = 'structures'
+ROOMS = 'rooms'
+DISCOUNTS = 'discounts'
+
+
+def get_read_cache_key(namespace, request):
+    """
+    Return the cache key of a GET request in the namespace.
+    The key contains the current version of the namespace, so bumping it invalidates every cached response.
+    """
+    version = cache.get_or_set(READ_CACHE_VERSION_KEY.format(namespace=namespace), 1, None)
+    # The absolute URI is used because the serialized image URLs contain the host
+    digest = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return READ_CACHE_KEY.format(namespace=namespace, version=version, digest=digest)
+
+
+def invalidate_read_cache(*namespaces):
+    """
+    Invalidate the cached reads of the namespaces by bumping their version,
+    the old entries are never read again and expire on their own.
+    """
+    for namespace in namespaces:
+        key = READ_CACHE_VERSION_KEY.format(namespace=namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The version expired or was never set
+            cache.set(key, 2, None)
+
+
+class CachedReadMixin:
+    """
+    Mixin for viewsets whose data changes rarely.
+    cached_read serves a read action from the cache, the writes made through the viewset
+    invalidate the namespaces listed in read_cache_invalidates.
+    """
+    read_cache_namespace = None
+    read_cache_invalidates = ()
+
+    def cached_read(self, handler, request, *args, **kwargs):
+        """
+        Return the cached data of the request, or call the handler and cache its data if the response is a 200
+        """
+        key = get_read_cache_key(self.read_cache_namespace, request)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, READ_CACHE_TIMEOUT)
+        return response
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        invalidate_read_cache(*self.read_cache_invalidates)
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        invalidate_read_cache(*self.read_cache_invalidates)
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        invalidate_read_cache(*self.read_cache_invalidates)
@@ -5,10 +5,14 @@ from datetime import date
 import uuid
 
 from django.db import models
+from django.db.models import Q, Value
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateRangeField, RangeOperators
 
 from .constants import (STATUS_CHOICES, PENDING_COMPLETE_DATA, TYPE_VALUES,
-                        CUSTOMER, ROOM_STATUS, AVAILABLE, STATUS_RESERVATION, UNPAID, CATEGORY_CHOICES)
+                        CUSTOMER, ROOM_STATUS, AVAILABLE, STATUS_RESERVATION, UNPAID, CANCELED,
+                        CATEGORY_CHOICES)
 
 
 class User(AbstractUser):
@@ -27,7 +31,7 @@ class User(AbstractUser):
     telephone = models.CharField(max_length=20, unique=True, blank=True, null=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES,
                               default=PENDING_COMPLETE_DATA)
-    type = models.CharField(max_length=10, choices=TYPE_VALUES, default=CUSTOMER)
+    type = models.CharField(max_length=10, choices=TYPE_VALUES, default=CUSTOMER, db_index=True)
     has_accepted_terms = models.BooleanField(default=False)
 
     def __str__(self):
@@ -80,6 +84,7 @@ class Room(models.Model):
     - max_people: Maximum occupancy of the room
     - calendar_id: Associated Google Calendar ID for the room
     - calendar_id_booking: Associated Google Calendar ID for the room of Booking.com
+    - last_calendar_change_at: Timestamp of the last change made by the app to the room calendars
     """
     structure = models.ForeignKey(Structure, on_delete=models.CASCADE, related_name='rooms')
     room_status = models.CharField(max_length=20, choices=ROOM_STATUS, default=AVAILABLE)
@@ -89,6 +94,7 @@ class Room(models.Model):
     max_people = models.PositiveIntegerField()
     calendar_id = models.CharField(max_length=255, blank=True, null=True)
     calendar_id_booking = models.CharField(max_length=255, blank=True, null=True)
+    last_calendar_change_at = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return f"{self.name} in {self.structure.name}"
@@ -110,6 +116,14 @@ class RoomImage(models.Model):
         return f"Image of {self.room.name}"
 
 
+class DateRange(models.Func):
+    """
+    Build a PostgreSQL daterange from two date expressions and the bounds (e.g. '[)').
+    """
+    function = 'DATERANGE'
+    output_field = DateRangeField()
+
+
 class Reservation(models.Model):
     """
     Model representing a reservation for a room.
@@ -121,6 +135,7 @@ class Reservation(models.Model):
     - check_in: Check-in date
     - check_out: Check-out date
     - number_of_people: Number of people staying in the room
+    - base_cost: Cost of the nights before any discount, computed when the reservation is created
     - total_cost: Total cost of the reservation
     - payment_intent_id: Stripe payment intent ID associated with the reservation
     - status: Status of the reservation (e.g., unpaid, paid, canceled)
@@ -130,6 +145,8 @@ class Reservation(models.Model):
     - email_on_reservation: Email of the person on the reservation
     - coupon_used: Coupon code used for the reservation, if any
     - created_at: Timestamp of when the reservation was created
+    - cached_line_items: Stripe Checkout line items built when the reservation is created
+    - period: Nights of the stay as a daterange [check_in, check_out), generated by the database
     """
     user = models.ForeignKey(
         User,
@@ -144,6 +161,7 @@ class Reservation(models.Model):
     check_in = models.DateField()
     check_out = models.DateField()
     number_of_people = models.PositiveIntegerField()
+    base_cost = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     total_cost = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     payment_intent_id = models.CharField(max_length=100, blank=True)
     status = models.CharField(max_length=20, choices=STATUS_RESERVATION, default=UNPAID)
@@ -153,6 +171,33 @@ class Reservation(models.Model):
     email_on_reservation = models.EmailField()
     coupon_used = models.CharField(max_length=20, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    cached_line_items = models.JSONField(default=list, blank=True, editable=False)
+    period = models.GeneratedField(
+        expression=DateRange('check_in', 'check_out', Value('[)')),
+        output_field=DateRangeField(),
+        db_persist=True
+    )
+
+    class Meta:
+        constraints = [
+            # Two reservations that are not canceled can't overlap on the same room
+            ExclusionConstraint(
+                name='exclude_overlapping_reservations',
+                expressions=[
+                    ('room', RangeOperators.EQUAL),
+                    ('period', RangeOperators.OVERLAPS),
+                ],
+                condition=~Q(status=CANCELED)
+            ),
+        ]
+        indexes = [
+            # Reservations of a room that are not over yet
+            models.Index(fields=['room', 'check_out'], name='reservation_room_check_out_idx'),
+            # Unpaid reservations that passed the payment timeout, paid and canceled ones are left out of the index
+            models.Index(fields=['created_at'], condition=Q(status=UNPAID), name='reservation_unpaid_created_idx'),
+            # Reservations checking in on a given day, for the self check-in reminders
+            models.Index(fields=['check_in'], name='reservation_check_in_idx'),
+        ]
 
     def __str__(self):
         return f"Reservation {self.reservation_id} by {self.user}"
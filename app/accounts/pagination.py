@@ -0,0 +1,10 @@
+from rest_framework.pagination import PageNumberPagination
+
+
+class UserListPagination(PageNumberPagination):
+    """
+    Pagination for the users list, enabled when the page or page_size query parameter is given.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
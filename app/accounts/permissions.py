@@ -0,0 +1,28 @@
+"""
+This file contains the DRF permission classes used in the accounts app.
+"""
+from rest_framework.permissions import BasePermission, SAFE_METHODS
+
+from accounts.constants import ADMIN
+
+
+class IsAdminType(BasePermission):
+    """
+    Allows access only to active users with the type ADMIN.
+    Relies only on the attributes of the authenticated user, so no query is issued: the verified email
+    and the completed profile are still checked by the is_active decorator of the handlers.
+    """
+    message = "Your account is not an admin account"
+
+    def has_permission(self, request, view):
+        user = request.user
+        return bool(user and user.is_authenticated and user.is_active and user.type == ADMIN)
+
+
+class IsAdminTypeOrReadOnly(IsAdminType):
+    """
+    Allows safe methods to everyone and write methods only to admin users.
+    """
+
+    def has_permission(self, request, view):
+        return request.method in SAFE_METHODS or super().has_permission(request, view)
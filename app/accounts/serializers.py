@@ -2,14 +2,15 @@
 Serializers for the accounts app.
 """
 import uuid
-from datetime import timedelta
+from datetime import datetime, time, timedelta, timezone as dt_timezone
 
 from django.contrib.auth import authenticate
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from .constants import CANCELED
+from .constants import CANCELED, UNPAID
 from .models import (User, Structure, Room, Reservation, Discount,
                      StructureImage, RoomImage, UserAlloggiatiWeb,
                      TokenInfoAlloggiatiWeb, CheckinCategoryChoices, DmsPugliaXml)
@@ -239,8 +240,8 @@ class ReservationSerializer(serializers.ModelSerializer):
         if data['check_in'] >= data['check_out']:
             raise serializers.ValidationError("Check-in date must be before check-out date.")
 
-        # Validate room existence
-        room = get_object_or_404(Room, id=data['room_id'])
+        # Validate room existence, the structure is loaded with it for the checkout line items
+        room = get_object_or_404(Room.objects.select_related('structure'), id=data['room_id'])
 
         # Validate the number of people
         if data['number_of_people'] > room.max_people:
@@ -507,22 +508,38 @@ class MovimentoSerializer(serializers.Serializer):
         Adds structure details like available rooms, occupied rooms, and total beds.
         """
 
-        from .functions import get_combined_busy_dates, is_room_available
+        from .functions import get_busy_dates_for_rooms, get_google_calendar_service, is_room_available
 
         structure = Structure.objects.get(id=validated_data['structure_id'])
-        rooms = Room.objects.filter(structure=structure)
+        rooms = list(Room.objects.filter(structure=structure))
 
-        check_in = validated_data['data']
+        check_in = datetime.combine(validated_data['data'], time.min, tzinfo=dt_timezone.utc)
         check_out = check_in + timedelta(days=1)
 
+        # Rooms with a reservation on the day, fetched with a single query for the whole structure.
+        # Canceled reservations and unpaid ones older than 10 minutes don't occupy the room
+        reserved_room_ids = set(Reservation.objects.filter(
+            room__in=rooms,
+            period__overlap=(check_in.date(), check_out.date())
+        ).exclude(status=CANCELED).exclude(
+            Q(status=UNPAID) & Q(created_at__lt=(timezone.now() - timedelta(minutes=10)))
+        ).values_list('room_id', flat=True))
+
+        # Busy dates of the calendars of the rooms not already reserved, fetched with batched freebusy queries
+        unreserved_rooms = [room for room in rooms if room.id not in reserved_room_ids]
+        busy_dates_by_room = {}
+        if unreserved_rooms:
+            busy_dates_by_room = get_busy_dates_for_rooms(get_google_calendar_service(), unreserved_rooms,
+                                                          check_in, check_out)
+
         # Calculate room availability using Google Calendar and reservation data
         available_rooms = 0
         occupied_rooms = 0
         total_beds = 0
 
         for room in rooms:
-            busy_dates = get_combined_busy_dates(room, check_in, check_out)
-            if is_room_available(busy_dates, check_in, check_out):
+            if room.id not in reserved_room_ids and is_room_available(busy_dates_by_room[room.id], check_in,
+                                                                      check_out):
                 available_rooms += 1
             else:
                 occupied_rooms += 1
@@ -535,7 +552,7 @@ class MovimentoSerializer(serializers.Serializer):
             'total_beds': total_beds
         }
 
-        return super().create(validated_data)
+        return validated_data
 
 
 class CheckinCategoryChoicesSerializer(serializers.ModelSerializer):
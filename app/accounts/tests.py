@@ -0,0 +1,158 @@
+from datetime import date, datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from accounts.constants import CANCELED, PAID
+from accounts.functions import busy_intervals_to_dates, busy_dates_to_intervals, get_month_starts
+from accounts.views import StripeWebhook
+
+
+def ordinals(*days):
+    return {day.toordinal() for day in days}
+
+
+class BusyIntervalsToDatesTests(SimpleTestCase):
+    """
+    The freebusy intervals are converted to busy dates in the time zone of the structures.
+    """
+
+    def test_all_day_event_in_winter(self):
+        # An all-day event on 10 January starts at the Rome midnight, 23:00Z the day before
+        intervals = [{'start': '2025-01-09T23:00:00Z', 'end': '2025-01-10T23:00:00Z'}]
+        self.assertEqual(busy_intervals_to_dates(intervals), ordinals(date(2025, 1, 10)))
+
+    def test_all_day_event_in_summer(self):
+        # In summer the Rome midnight is 22:00Z
+        intervals = [{'start': '2025-07-09T22:00:00Z', 'end': '2025-07-11T22:00:00Z'}]
+        self.assertEqual(busy_intervals_to_dates(intervals), ordinals(date(2025, 7, 10), date(2025, 7, 11)))
+
+    def test_interval_with_offset(self):
+        intervals = [{'start': '2025-07-10T00:00:00+02:00', 'end': '2025-07-11T00:00:00+02:00'}]
+        self.assertEqual(busy_intervals_to_dates(intervals), ordinals(date(2025, 7, 10)))
+
+    def test_end_is_exclusive(self):
+        # A booking from 14:00 to 10:00 the next day occupies both days, ending at the midnight it doesn't
+        intervals = [
+            {'start': '2025-03-03T13:00:00Z', 'end': '2025-03-04T09:00:00Z'},
+            {'start': '2025-03-10T23:00:00Z', 'end': '2025-03-11T23:00:00Z'},
+        ]
+        self.assertEqual(
+            busy_intervals_to_dates(intervals),
+            ordinals(date(2025, 3, 3), date(2025, 3, 4), date(2025, 3, 11))
+        )
+
+    def test_no_intervals(self):
+        self.assertEqual(busy_intervals_to_dates([]), set())
+
+
+class GetMonthStartsTests(SimpleTestCase):
+    """
+    The busy dates are cached per month, the months of a range are those it overlaps.
+    """
+
+    def test_range_within_a_month(self):
+        self.assertEqual(get_month_starts(date(2025, 3, 3), date(2025, 3, 10)), [date(2025, 3, 1)])
+
+    def test_end_is_exclusive(self):
+        # A stay checking out on the 1st doesn't overlap the month of the check-out
+        self.assertEqual(get_month_starts(date(2025, 3, 28), date(2025, 4, 1)), [date(2025, 3, 1)])
+        self.assertEqual(
+            get_month_starts(date(2025, 3, 28), date(2025, 4, 2)), [date(2025, 3, 1), date(2025, 4, 1)]
+        )
+
+    def test_range_across_the_year(self):
+        self.assertEqual(
+            get_month_starts(date(2024, 11, 30), date(2025, 2, 15)),
+            [date(2024, 11, 1), date(2024, 12, 1), date(2025, 1, 1), date(2025, 2, 1)]
+        )
+
+    def test_datetime_bounds(self):
+        # The views pass the midnights of the requested dates
+        self.assertEqual(
+            get_month_starts(datetime(2025, 1, 31), datetime(2025, 3, 1)), [date(2025, 1, 1), date(2025, 2, 1)]
+        )
+
+
+class BusyDatesToIntervalsTests(SimpleTestCase):
+    """
+    The busy dates of a room are grouped into intervals whose end is excluded.
+    """
+
+    def test_consecutive_dates_are_merged(self):
+        busy_dates = ordinals(date(2025, 3, 3), date(2025, 3, 4), date(2025, 3, 5))
+        self.assertEqual(busy_dates_to_intervals(busy_dates), [{'start': '2025-03-03', 'end': '2025-03-06'}])
+
+    def test_gaps_split_the_intervals(self):
+        busy_dates = ordinals(date(2025, 3, 10), date(2025, 3, 3), date(2025, 3, 4), date(2025, 3, 12))
+        self.assertEqual(busy_dates_to_intervals(busy_dates), [
+            {'start': '2025-03-03', 'end': '2025-03-05'},
+            {'start': '2025-03-10', 'end': '2025-03-11'},
+            {'start': '2025-03-12', 'end': '2025-03-13'},
+        ])
+
+    def test_interval_across_months(self):
+        busy_dates = ordinals(date(2024, 12, 31), date(2025, 1, 1))
+        self.assertEqual(busy_dates_to_intervals(busy_dates), [{'start': '2024-12-31', 'end': '2025-01-02'}])
+
+    def test_round_trip_with_freebusy_intervals(self):
+        busy_dates = ordinals(date(2025, 7, 10), date(2025, 7, 11), date(2025, 7, 20))
+        intervals = [
+            {'start': f"{interval['start']}T00:00:00+02:00", 'end': f"{interval['end']}T00:00:00+02:00"}
+            for interval in busy_dates_to_intervals(busy_dates)
+        ]
+        self.assertEqual(busy_intervals_to_dates(intervals), busy_dates)
+
+    def test_no_busy_dates(self):
+        self.assertEqual(busy_dates_to_intervals(set()), [])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StripeWebhookDedupTests(SimpleTestCase):
+    """
+    Stripe delivers an event at least once, a checkout session is only completed on its first delivery.
+    """
+
+    event = {'id': 'evt_test', 'type': 'checkout.session.completed', 'data': {'object': {'id': 'cs_test'}}}
+
+    def setUp(self):
+        cache.clear()
+        # The signature is not checked, the event is the one returned by construct_event
+        mock.patch.object(StripeWebhook, 'is_timestamp_recent', return_value=True).start()
+        mock.patch('accounts.views.stripe.Webhook.construct_event', return_value=self.event).start()
+        self.handle_session = mock.patch('accounts.views.handle_checkout_session_completed').start()
+        self.complete_payment = mock.patch('accounts.views.complete_reservation_payment').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def deliver(self):
+        request = RequestFactory().post('/stripe-webhook/', data=b'{}', content_type='application/json',
+                                        HTTP_STRIPE_SIGNATURE='t=1,v1=signature')
+        return StripeWebhook.as_view()(request)
+
+    def test_duplicate_delivery_is_only_acknowledged(self):
+        self.handle_session.return_value = mock.Mock(id=7, status=PAID)
+
+        self.assertEqual(self.deliver().status_code, 200)
+        self.assertEqual(self.deliver().status_code, 200)
+
+        self.handle_session.assert_called_once_with(self.event['data']['object'])
+        self.complete_payment.delay.assert_called_once_with(7)
+
+    def test_unhandled_delivery_is_handled_again(self):
+        # The reservation couldn't be updated, Stripe is asked to retry and the retry must not be skipped
+        self.handle_session.return_value = None
+        self.assertEqual(self.deliver().status_code, 500)
+        self.complete_payment.delay.assert_not_called()
+
+        self.handle_session.return_value = mock.Mock(id=7, status=PAID)
+        self.assertEqual(self.deliver().status_code, 200)
+
+        self.assertEqual(self.handle_session.call_count, 2)
+        self.complete_payment.delay.assert_called_once_with(7)
+
+    def test_refunded_reservation_is_not_completed(self):
+        # The reservation was canceled and its dates booked again, the payment was refunded
+        self.handle_session.return_value = mock.Mock(id=7, status=CANCELED)
+        self.assertEqual(self.deliver().status_code, 200)
+        self.complete_payment.delay.assert_not_called()
@@ -14,7 +14,7 @@ from .views import (UsersListAPI, UserDetailAPI, CompleteProfileAPI,
                     RemoveAdminTypeUserAPI, CreateRoomAPI, CalculateDiscountAPI,
                     GetRoomImagesAPI, AddRoomImageAPI, DeleteRoomImageAPI,
                     UploadDataDmsPugliaXmlAPI, ListDmsPugliaXmlFilesAPI, DownloadDmsPugliaXmlFileAPI,
-                    SendWhatsAppToAllUsersAPI)
+                    SendWhatsAppToAllUsersAPI, RoomBusyIntervalsAPI)
 
 # Create the router and register the viewsets with it.
 router = DefaultRouter()
@@ -42,6 +42,7 @@ urlpatterns = [
     path('room/create-room/', CreateRoomAPI.as_view(), name='create-room'),
     path('room/rent-room/', RentRoomAPI.as_view(), name='rent-room'),
     path('room/available-rooms-for-dates/', AvailableRoomsForDatesAPI.as_view(), name='available-rooms-for-dates'),
+    path('room/<int:pk>/busy-intervals/', RoomBusyIntervalsAPI.as_view(), name='room-busy-intervals'),
     path('discount/calculate-discount/', CalculateDiscountAPI.as_view(), name='calculate-discount'),
     path('stripe/create-checkout-session/', CreateCheckoutSessionLinkAPI.as_view(), name='create-checkout-session'),
     path('send-whatsapp-to-all-users/', SendWhatsAppToAllUsersAPI.as_view(), name='send-whatsapp-to-all-users'),
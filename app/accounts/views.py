@@ -1,25 +1,32 @@
 """
 This module contains the views of the accounts app.
 """
-import io
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-import pytz
 import stripe
-import xml.etree.ElementTree as ET
 
 from django.core.files.base import ContentFile
-from django.http import FileResponse
+from django.http import FileResponse, JsonResponse
+from lxml import etree
 
+from celery_tasks.tasks import cancel_reservation, complete_reservation_payment
 from .constants import PENDING_COMPLETE_DATA, COMPLETE, ADMIN, CANCELED, CUSTOMER, PAID, UNPAID
 from .filters import ReservationFilter
-from .functions import (is_active, is_admin, calculate_total_cost, calculate_discount,
+from .functions import (is_active, calculate_total_cost, calculate_discount,
                         get_google_calendar_service, get_busy_dates_from_reservations,
-                        cancel_reservation_and_remove_event,
                         is_room_available, handle_checkout_session_completed, parse_soap_response,
                         build_soap_envelope,
                         send_soap_request, send_account_deletion_email, WhatsAppService, generate_dms_puglia_xml,
-                        get_busy_dates_from_calendars, get_combined_busy_dates)
+                        get_busy_dates_from_calendars, get_busy_dates_for_rooms, get_combined_busy_dates,
+                        get_date_range, busy_dates_to_intervals, build_line_items, get_image_url,
+                        get_rooms_with_images,
+                        invalidate_google_calendar_service, get_google_calendar_credentials,
+                        run_with_google_calendar_service)
+from .mixins import CachedReadMixin, invalidate_read_cache, STRUCTURES, ROOMS, DISCOUNTS
+from .pagination import UserListPagination
+from .permissions import IsAdminType, IsAdminTypeOrReadOnly
 from .models import User, Structure, Room, Reservation, Discount, GoogleOAuthCredentials, StructureImage, RoomImage, \
     CheckinCategoryChoices, DmsPugliaXml
 from .serializers import (UserSerializer, CompleteProfileSerializer, StructureSerializer,
@@ -30,55 +37,124 @@ from .serializers import (UserSerializer, CompleteProfileSerializer, StructureSe
                           SendElencoSchedineSerializer, CheckinCategoryChoicesSerializer,
                           SendWhatsAppToAllUsersSerializer, SchedinaSerializer, MovimentoSerializer,
                           DmsPugliaXmlSerializer)
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import transaction
-from django.db.models import Case, When, Value, IntegerField, Q
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django_filters.rest_framework import DjangoFilterBackend
 from google_auth_oauthlib.flow import Flow
-from rest_framework import status, filters, viewsets
+from rest_framework import status, filters, generics, viewsets
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.throttling import ScopedRateThrottle
 from rest_framework.views import APIView
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 logger = logging.getLogger(__name__)
 
-
-class UsersListAPI(APIView):
+# Settings read on every webhook and OAuth request, resolved once when the module is loaded
+STRIPE_WEBHOOK_SECRET = settings.STRIPE_WEBHOOK_SECRET
+STRIPE_EVENT_CACHE_KEY = 'stripe_event:{event_id}'
+STRIPE_EVENT_CACHE_TIMEOUT = 24 * 60 * 60  # One day, later duplicates no longer match the reservation session id
+# The amount is part of the key, a session for a discounted total is a new request for Stripe
+CHECKOUT_SESSION_IDEMPOTENCY_KEY = 'checkout-{reservation_id}-{amount}'
+# Seconds a booking waits for the Google Calendars of the room before giving up
+BOOKING_CALENDAR_TIMEOUT = 15
+# Longest range of the availability searches, each month of the range is a freebusy query per calendar
+MAX_AVAILABILITY_RANGE_DAYS = 365
+GOOGLE_REDIRECT_URI = settings.GOOGLE_REDIRECT_URI
+GOOGLE_CALENDAR_SCOPES = ['https://www.googleapis.com/auth/calendar']
+GOOGLE_CLIENT_CONFIG = {
+    "web": {
+        "client_id": settings.GOOGLE_CLIENT_ID,
+        "client_secret": settings.GOOGLE_CLIENT_SECRET,
+        "redirect_uris": [GOOGLE_REDIRECT_URI],
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token"
+    }
+}
+
+# Maximum number of image rows sent in a single INSERT when uploading images
+IMAGE_BULK_CREATE_BATCH_SIZE = 100
+
+# Threads used to call third-party APIs (Google Calendar, Stripe) while the local database is used.
+# Each kind of call has its own pool, so the public availability searches can't hold up bookings and payments
+availability_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='availability-io')
+booking_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='booking-io')
+checkout_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='checkout-io')
+
+
+class UsersListAPI(generics.GenericAPIView):
     """
-    List all users or create a new user
+    List all users or create a new user.
+    The type and status filters, the search and the ordering are applied by the filter backends in the query.
+    With ?compact=true the rows are returned as plain dicts of the main columns,
+    skipping the model instances and the serializer.
+    With ?page or ?page_size the users are paginated and ordered by id, unless an ordering is given.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = UserSerializer
+    queryset = User.objects.all()
+    pagination_class = UserListPagination
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filterset_fields = ['type', 'status']
+    search_fields = ['email', 'first_name', 'last_name', 'telephone']
+    ordering_fields = ['id', 'email', 'first_name', 'last_name', 'date_joined']
+    compact_fields = ('id', 'email', 'type', 'first_name', 'last_name', 'is_active', 'is_superuser')
 
     @method_decorator(is_active)
     def get(self, request):
         user = request.user
-        queryset = User.objects.all()
+        compact = request.query_params.get('compact', '').lower() in ('1', 'true')
 
+        # Regular users can only see themselves, the authenticated user is already loaded
         if not user.is_superuser and user.type != ADMIN:
-            queryset = queryset.filter(id=user.id)
+            if compact:
+                return Response([{field: getattr(user, field) for field in self.compact_fields}],
+                                status=status.HTTP_200_OK)
+            return Response(self.serializer_class([user], many=True).data, status=status.HTTP_200_OK)
+
+        queryset = self.filter_queryset(self.get_queryset())
+
+        if compact:
+            queryset = queryset.values(*self.compact_fields)
         else:
-            type_param = request.query_params.get('type', None)
-            if type_param:
-                queryset = queryset.filter(type=type_param)
-
-        queryset = queryset.annotate(
-            is_logged_in_user=Case(
-                When(id=user.id, then=Value(1)),
-                default=Value(0),
-                output_field=IntegerField()
-            )
-        ).order_by('-is_logged_in_user')
+            # UserSerializer exposes every column, including the groups and permissions many-to-many fields
+            queryset = queryset.prefetch_related('groups', 'user_permissions')
+
+        if 'page' in request.query_params or 'page_size' in request.query_params:
+            if not queryset.ordered:
+                queryset = queryset.order_by('id')
+            page = self.paginate_queryset(queryset)
+            data = page if compact else self.serializer_class(page, many=True).data
+            return self.get_paginated_response(data)
+
+        if compact:
+            users = list(queryset)
+            return Response(self.logged_in_user_first(users, user.id, lambda row: row['id']),
+                            status=status.HTTP_200_OK)
 
-        serializer = self.serializer_class(queryset, many=True)
+        users = list(queryset)
+        serializer = self.serializer_class(self.logged_in_user_first(users, user.id, lambda obj: obj.id), many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @staticmethod
+    def logged_in_user_first(users, user_id, get_id):
+        """
+        Move the logged-in user to the top of the list, the order of the other users is kept
+        """
+        for index, item in enumerate(users):
+            if get_id(item) == user_id:
+                users.insert(0, users.pop(index))
+                break
+        return users
+
 
 class UserDetailAPI(APIView):
     """
@@ -92,23 +168,22 @@ class UserDetailAPI(APIView):
         """
         Get the user object by primary
         """
-        try:
-            return User.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        # UserSerializer exposes the groups and permissions many-to-many fields
+        return User.objects.prefetch_related('groups', 'user_permissions').filter(pk=pk).first()
 
     @method_decorator(is_active)
     def get(self, request, pk):
         """
         Get the user instance by primary key
         """
+        # Only admins can see other users, so the user isn't fetched for everyone else
+        if not (request.user.is_superuser or request.user.type == ADMIN):
+            return Response(status=status.HTTP_403_FORBIDDEN)
         obj = self.get_object(pk)
         if obj is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
         serializer = self.serializer_class(obj)
-        if request.user.is_superuser or request.user.type == ADMIN:
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        return Response(status=status.HTTP_403_FORBIDDEN)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
     @method_decorator(is_active)
     def put(self, request, pk):
@@ -134,7 +209,8 @@ class UserDetailAPI(APIView):
         It is a physical delete.
         The user can only delete their profile if they have no active reservations.
         """
-        obj = self.get_object(pk)
+        # The groups and permissions are only needed to serialize the user
+        obj = User.objects.filter(pk=pk).first()
         if obj is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -192,7 +268,7 @@ class CompleteProfileAPI(APIView):
                 user.telephone = serializer.validated_data['telephone']
                 user.has_accepted_terms = has_accepted_terms
                 user.status = COMPLETE
-                user.save()
+                user.save(update_fields=['first_name', 'last_name', 'telephone', 'has_accepted_terms', 'status'])
                 return Response({'user_status': COMPLETE}, status=status.HTTP_200_OK)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return Response({f"The User: {user}, has already completed his profile"},
@@ -203,11 +279,10 @@ class AddAdminTypeUserAPI(APIView):
     """
     API to add an admin type user
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = EmailSerializer
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def post(self, request):
         """
         Add an admin type user
@@ -220,7 +295,7 @@ class AddAdminTypeUserAPI(APIView):
             if serializer.is_valid():
                 user = User.objects.get(email=serializer.validated_data['email'])
                 user.type = ADMIN
-                user.save()
+                user.save(update_fields=['type'])
                 return Response({'message': f'{user} is now an admin type user'}, status=status.HTTP_200_OK)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return Response({'error': 'You are not authorized to perform this action'}, status=status.HTTP_403_FORBIDDEN)
@@ -230,11 +305,10 @@ class RemoveAdminTypeUserAPI(APIView):
     """
     API to add an admin type user
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = EmailSerializer
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def post(self, request):
         """
         Remove an admin type user
@@ -247,7 +321,7 @@ class RemoveAdminTypeUserAPI(APIView):
             if serializer.is_valid():
                 user = User.objects.get(email=serializer.validated_data['email'])
                 user.type = CUSTOMER
-                user.save()
+                user.save(update_fields=['type'])
                 return Response({'message': f'{user} is now a customer type user'}, status=status.HTTP_200_OK)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return Response({'error': 'You are not authorized to perform this action'}, status=status.HTTP_403_FORBIDDEN)
@@ -257,11 +331,10 @@ class CreateStructureAPI(APIView):
     """
     API to create a structure
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = StructureSerializer
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def post(self, request):
         """
         Create a structure
@@ -269,6 +342,7 @@ class CreateStructureAPI(APIView):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             serializer.save()
+            invalidate_read_cache(STRUCTURES)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -284,10 +358,7 @@ class GetStructureImagesAPI(APIView):
         """
         Get the user object by primary
         """
-        try:
-            return Structure.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return Structure.objects.filter(pk=pk).first()
 
     def get(self, request, pk):
         """
@@ -305,21 +376,17 @@ class AddStructureImageAPI(APIView):
     """
     API to add an image to a structure
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = StructureImageSerializer
 
     @staticmethod
     def get_object(pk):
         """
-        Get the user object by primary
+        Get the structure object by primary key, only its id is needed to attach the images
         """
-        try:
-            return Structure.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return Structure.objects.only('id').filter(pk=pk).first()
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def post(self, request, pk):
         """
         Add an image to a structure
@@ -335,9 +402,10 @@ class AddStructureImageAPI(APIView):
         structure_images = [StructureImage(structure=obj, image=image) for image in images]
 
         try:
-            StructureImage.objects.bulk_create(structure_images)
+            StructureImage.objects.bulk_create(structure_images, batch_size=IMAGE_BULK_CREATE_BATCH_SIZE)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        invalidate_read_cache(STRUCTURES)
 
         serializer = self.serializer_class(structure_images, many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -347,20 +415,16 @@ class DeleteStructureImageAPI(APIView):
     """
     API to delete an image from a structure
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
 
     @staticmethod
     def get_object(pk):
         """
         Get the user object by primary
         """
-        try:
-            return StructureImage.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return StructureImage.objects.only('id', 'image').filter(pk=pk).first()
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def delete(self, request, pk):
         """
         Delete an image from a structure
@@ -369,43 +433,75 @@ class DeleteStructureImageAPI(APIView):
         if obj is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
         obj.delete()
+        invalidate_read_cache(STRUCTURES)
         return Response(status=status.HTTP_200_OK)
 
 
-class StructureViewSet(viewsets.ModelViewSet):
+class StructureViewSet(CachedReadMixin, viewsets.ModelViewSet):
     """
     A viewset for viewing and editing structure instances.
     """
+    read_cache_namespace = STRUCTURES
+    # Deleting a structure deletes its rooms, which can be part of discounts
+    read_cache_invalidates = (STRUCTURES, ROOMS, DISCOUNTS)
     serializer_class = StructureRoomSerializer
-    queryset = Structure.objects.prefetch_related('rooms', 'images').all()
+    queryset = Structure.objects.prefetch_related('rooms__images', 'images').all()
+    permission_classes = [IsAdminTypeOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_fields = ['name', 'address']
     search_fields = ['name', 'address', 'description']
     ordering_fields = ['name', 'address']
 
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        return self.cached_read(self.list_structures, request, *args, **kwargs)
+
+    def list_structures(self, request, *args, **kwargs):
+        """
+        List the structures with their rooms and images.
+        The rows are read with values() and grouped in dicts with the same shape as StructureRoomSerializer,
+        so the nested serializers aren't instantiated for every structure, room and image
+        """
+        structures = list(self.filter_queryset(Structure.objects.all()).values(
+            'id', 'name', 'description', 'address', 'cis'
+        ))
+        structure_ids = [structure['id'] for structure in structures]
+
+        rooms = get_rooms_with_images(request, Room.objects.filter(structure_id__in=structure_ids).order_by('id'))
+        structure_images = StructureImage.objects.filter(structure_id__in=structure_ids).order_by('id').values(
+            'id', 'image', 'alt', 'structure'
+        )
+
+        rooms_by_structure = defaultdict(list)
+        for room in rooms:
+            rooms_by_structure[room['structure']].append(room)
+
+        images_by_structure = defaultdict(list)
+        for image in structure_images:
+            image['image'] = get_image_url(request, StructureImage, image['image'])
+            images_by_structure[image['structure']].append(image)
+
+        for structure in structures:
+            structure['rooms'] = rooms_by_structure[structure['id']]
+            structure['images'] = images_by_structure[structure['id']]
+
+        return Response(structures)
 
     def retrieve(self, request, *args, **kwargs):
-        return super().retrieve(request, *args, **kwargs)
+        return self.cached_read(super().retrieve, request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def create(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def update(self, request, *args, **kwargs):
         return super().update(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def partial_update(self, request, *args, **kwargs):
         return super().partial_update(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def destroy(self, request, *args, **kwargs):
         return super().destroy(request, *args, **kwargs)
 
@@ -414,11 +510,10 @@ class CreateRoomAPI(APIView):
     """
     API to create a room and associated Google Calendar
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = RoomSerializer
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     @transaction.atomic
     def post(self, request):
         """
@@ -432,7 +527,8 @@ class CreateRoomAPI(APIView):
                 calendar_id = self.create_google_calendar(room)
                 # Save the calendar ID to the room
                 room.calendar_id = calendar_id
-                room.save()
+                room.save(update_fields=['calendar_id'])
+                transaction.on_commit(lambda: invalidate_read_cache(ROOMS, STRUCTURES))
 
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             except Exception as e:
@@ -484,10 +580,7 @@ class GetRoomImagesAPI(APIView):
         """
         Get the room object by primary key
         """
-        try:
-            return Room.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return Room.objects.filter(pk=pk).first()
 
     def get(self, request, pk):
         """
@@ -505,21 +598,17 @@ class AddRoomImageAPI(APIView):
     """
     API to add an image to a room
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = RoomImageSerializer
 
     @staticmethod
     def get_object(pk):
         """
-        Get the room object by primary key
+        Get the room object by primary key, only its id is needed to attach the images
         """
-        try:
-            return Room.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return Room.objects.only('id').filter(pk=pk).first()
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def post(self, request, pk):
         """
         Add an image to a room
@@ -535,9 +624,10 @@ class AddRoomImageAPI(APIView):
         room_images = [RoomImage(room=obj, image=image) for image in images]
 
         try:
-            RoomImage.objects.bulk_create(room_images)
+            RoomImage.objects.bulk_create(room_images, batch_size=IMAGE_BULK_CREATE_BATCH_SIZE)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        invalidate_read_cache(ROOMS, STRUCTURES)
 
         serializer = self.serializer_class(room_images, many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -547,20 +637,16 @@ class DeleteRoomImageAPI(APIView):
     """
     API to delete an image from a room
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
 
     @staticmethod
     def get_object(pk):
         """
         Get the room image object by primary key
         """
-        try:
-            return RoomImage.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return RoomImage.objects.filter(pk=pk).first()
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def delete(self, request, pk):
         """
         Delete an image from a room
@@ -569,43 +655,50 @@ class DeleteRoomImageAPI(APIView):
         if obj is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
         obj.delete()
+        invalidate_read_cache(ROOMS, STRUCTURES)
         return Response(status=status.HTTP_200_OK)
 
 
-class RoomViewSet(viewsets.ModelViewSet):
+class RoomViewSet(CachedReadMixin, viewsets.ModelViewSet):
     """
     A viewset for viewing and editing room instances.
     """
+    read_cache_namespace = ROOMS
+    # The structures embed their rooms and the discounts list the rooms they apply to
+    read_cache_invalidates = (ROOMS, STRUCTURES, DISCOUNTS)
     serializer_class = RoomSerializer
-    queryset = Room.objects.all()
+    queryset = Room.objects.prefetch_related('images').all()
+    permission_classes = [IsAdminTypeOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_fields = ['structure', 'cost_per_night', 'max_people']
     search_fields = ['name', 'services']
     ordering_fields = ['name', 'cost_per_night', 'max_people']
 
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        return self.cached_read(self.list_rooms, request, *args, **kwargs)
+
+    def list_rooms(self, request, *args, **kwargs):
+        """
+        List the rooms with their images, read with values() and returned in the shape of RoomSerializer
+        """
+        return Response(get_rooms_with_images(request, self.filter_queryset(Room.objects.all())))
 
     def retrieve(self, request, *args, **kwargs):
-        return super().retrieve(request, *args, **kwargs)
+        return self.cached_read(super().retrieve, request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def create(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def update(self, request, *args, **kwargs):
         return super().update(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def partial_update(self, request, *args, **kwargs):
         return super().partial_update(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def destroy(self, request, *args, **kwargs):
         return super().destroy(request, *args, **kwargs)
 
@@ -616,7 +709,7 @@ class ReservationViewSet(viewsets.ModelViewSet):
     """
     serializer_class = ReservationSerializer
     queryset = Reservation.objects.all()
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminTypeOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_class = ReservationFilter
     search_fields = ['first_name_on_reservation', 'last_name_on_reservation', 'email_on_reservation']
@@ -624,9 +717,14 @@ class ReservationViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        # Load the nested user and room with their many-to-many fields and images in a few queries,
+        # the checkout line items aren't serialized so they are not read
+        reservations = Reservation.objects.select_related('user', 'room').prefetch_related(
+            'user__groups', 'user__user_permissions', 'room__images'
+        ).defer('cached_line_items')
         if user.is_superuser or user.type == ADMIN:
-            return Reservation.objects.all()  # Superuser/admin can see all reservations
-        return Reservation.objects.filter(user=user)  # Regular user can see only their own reservations
+            return reservations.all()  # Superuser/admin can see all reservations
+        return reservations.filter(user=user)  # Regular user can see only their own reservations
 
     @method_decorator(is_active)
     def list(self, request, *args, **kwargs):
@@ -637,60 +735,55 @@ class ReservationViewSet(viewsets.ModelViewSet):
         return super().retrieve(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def create(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def update(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def partial_update(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def destroy(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
-class DiscountViewSet(viewsets.ModelViewSet):
+class DiscountViewSet(CachedReadMixin, viewsets.ModelViewSet):
     """
     A viewset for viewing and editing discount instances.
     """
+    read_cache_namespace = DISCOUNTS
+    read_cache_invalidates = (DISCOUNTS,)
     serializer_class = DiscountSerializer
     queryset = Discount.objects.all()
+    permission_classes = [IsAdminTypeOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_fields = ['code', 'start_date', 'end_date']
     search_fields = ['code', 'description']
     ordering_fields = ['code', 'discount', 'start_date', 'end_date']
 
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        return self.cached_read(super().list, request, *args, **kwargs)
 
     def retrieve(self, request, *args, **kwargs):
-        return super().retrieve(request, *args, **kwargs)
+        return self.cached_read(super().retrieve, request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def create(self, request, *args, **kwargs):
         return super().create(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def update(self, request, *args, **kwargs):
         return super().update(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def partial_update(self, request, *args, **kwargs):
         return super().partial_update(request, *args, **kwargs)
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def destroy(self, request, *args, **kwargs):
         return super().destroy(request, *args, **kwargs)
 
@@ -703,17 +796,9 @@ class GoogleCalendarInitAPI(APIView):
         try:
             # Crea il flusso OAuth2 per Google Calendar
             flow = Flow.from_client_config(
-                {
-                    "web": {
-                        "client_id": settings.GOOGLE_CLIENT_ID,
-                        "client_secret": settings.GOOGLE_CLIENT_SECRET,
-                        "redirect_uris": [settings.GOOGLE_REDIRECT_URI],
-                        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                        "token_uri": "https://oauth2.googleapis.com/token"
-                    }
-                },
-                redirect_uri=settings.GOOGLE_REDIRECT_URI,
-                scopes=['https://www.googleapis.com/auth/calendar']
+                GOOGLE_CLIENT_CONFIG,
+                redirect_uri=GOOGLE_REDIRECT_URI,
+                scopes=GOOGLE_CALENDAR_SCOPES
             )
 
             # Forza Google a chiedere il refresh token con prompt='consent' e access_type='offline'
@@ -741,17 +826,9 @@ class GoogleCalendarRedirectAPI(APIView):
         try:
             # Inizia il flusso di autenticazione OAuth2
             flow = Flow.from_client_config(
-                {
-                    "web": {
-                        "client_id": settings.GOOGLE_CLIENT_ID,
-                        "client_secret": settings.GOOGLE_CLIENT_SECRET,
-                        "redirect_uris": [settings.GOOGLE_REDIRECT_URI],
-                        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                        "token_uri": "https://oauth2.googleapis.com/token"
-                    }
-                },
-                redirect_uri=settings.GOOGLE_REDIRECT_URI,
-                scopes=['https://www.googleapis.com/auth/calendar']
+                GOOGLE_CLIENT_CONFIG,
+                redirect_uri=GOOGLE_REDIRECT_URI,
+                scopes=GOOGLE_CALENDAR_SCOPES
             )
 
             # Scambia il codice di autorizzazione con un token
@@ -772,6 +849,7 @@ class GoogleCalendarRedirectAPI(APIView):
                     'scopes': ' '.join(credentials.scopes)
                 }
             )
+            invalidate_google_calendar_service()
 
             logger.info("Google Calendar credentials updated successfully in the database.")
             return Response({'message': 'Google Calendar credentials have been successfully updated.'},
@@ -844,38 +922,81 @@ class GoogleCalendarRedirectAPI(APIView):
 #             return Response({'error': 'Credentials not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
-class StripeWebhook(APIView):
+@method_decorator(csrf_exempt, name='dispatch')
+class StripeWebhook(View):
     """
-    API to create a payment intent for a reservation payment using Stripe
+    Webhook called by Stripe when a checkout session is completed.
+    It is a plain Django view: Stripe doesn't authenticate with a JWT and the body is verified
+    with its signature, so the DRF authentication, parsing and rendering are not needed.
     """
 
-    @method_decorator(csrf_exempt)
     def post(self, request):
         """
         API to handle Stripe webhooks
         """
-        payload = request.body
-        sig_header = request.META['HTTP_STRIPE_SIGNATURE']
-        endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
+        sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
+        if not sig_header:
+            return JsonResponse({'error': 'Missing Stripe signature header.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Replayed or malformed deliveries are rejected from the header alone, before the payload is hashed
+        if not self.is_timestamp_recent(sig_header):
+            return JsonResponse({'error': 'Timestamp outside the tolerance zone.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
             event = stripe.Webhook.construct_event(
-                payload, sig_header, endpoint_secret
+                request.body, sig_header, STRIPE_WEBHOOK_SECRET
             )
         except ValueError as e:
-            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except stripe.error.SignatureVerificationError as e:
-            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         # Handle the event
         if event['type'] == 'checkout.session.completed':
+            # Stripe delivers an event at least once, a delivery of an event already handled is only acknowledged
+            event_key = STRIPE_EVENT_CACHE_KEY.format(event_id=event['id'])
+            if not cache.add(event_key, True, STRIPE_EVENT_CACHE_TIMEOUT):
+                logger.info(f"Stripe event {event['id']} already handled")
+                return JsonResponse({'status': 'success'}, status=status.HTTP_200_OK)
+
             session = event['data']['object']
-            handle_checkout_session_completed(session)
+            reservation = handle_checkout_session_completed(session)
+            if reservation is None:
+                # Release the event and answer with an error, so Stripe delivers it again and it is handled again
+                cache.delete(event_key)
+                return JsonResponse({'error': 'The reservation could not be updated.'},
+                                    status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return Response({'status': 'success'}, status=status.HTTP_200_OK)
+            # A payment for a canceled reservation whose dates were booked again was refunded
+            if reservation.status == PAID:
+                # Google Calendar and the confirmation emails are handled by Celery, Stripe gets its answer right away
+                complete_reservation_payment.delay(reservation.id)
+
+        return JsonResponse({'status': 'success'}, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def is_timestamp_recent(sig_header):
+        """
+        Check the t= timestamp of the Stripe-Signature header against the tolerance used by the Stripe SDK.
+        The signature itself is still verified by stripe.Webhook.construct_event.
+        """
+        for item in sig_header.split(','):
+            key, _, value = item.partition('=')
+            if key == 't':
+                try:
+                    return int(value) >= timezone.now().timestamp() - stripe.Webhook.DEFAULT_TOLERANCE
+                except ValueError:
+                    return False
+        return False
 
 
 class AvailableRoomsForDatesAPI(APIView):
+    """
+    API to list the rooms available between two dates for a number of people.
+    Open to everyone, so the requests are throttled and the range of dates is bounded.
+    """
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = 'availability'
     serializer_class = AvailableRoomsForDatesSerializer
 
     def get(self, request):
@@ -888,59 +1009,133 @@ class AvailableRoomsForDatesAPI(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            check_in = datetime.strptime(check_in_date, '%Y-%m-%d').replace(tzinfo=pytz.UTC)
-            check_out = datetime.strptime(check_out_date, '%Y-%m-%d').replace(tzinfo=pytz.UTC)
+            check_in = datetime.combine(date.fromisoformat(check_in_date), time.min, tzinfo=dt_timezone.utc)
+            check_out = datetime.combine(date.fromisoformat(check_out_date), time.min, tzinfo=dt_timezone.utc)
             max_people = int(number_of_people)
         except ValueError:
             return Response({
                 'error': 'Invalid date format or number_of_people. Use YYYY-MM-DD for dates and ensure number_of_people is an integer.'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        # Build the Google Calendar service once
+        if check_in >= check_out:
+            return Response({'error': 'Check-in date must be before check-out date.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if (check_out - check_in).days > MAX_AVAILABILITY_RANGE_DAYS:
+            return Response({'error': f'The dates can be at most {MAX_AVAILABILITY_RANGE_DAYS} days apart.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Load the Google Calendar credentials before querying the database
         try:
-            service = get_google_calendar_service()
+            get_google_calendar_credentials()
         except Exception as e:
             logger.error(f"Error building Google Calendar service: {str(e)}")
             return Response({'error': 'Error connecting to Google Calendar service.'},
                             status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Filter rooms available for the selected dates and number of people from the local database
-        current_time = timezone.now()
-        available_rooms = Room.objects.filter(
+        # Rooms that can host the number of people, the structure images are prefetched for the serializer
+        rooms = list(Room.objects.filter(
             max_people__gte=max_people
-        ).exclude(
-            Q(reservations__check_in__lt=check_out, reservations__check_out__gt=check_in) &
+        ).select_related('structure').prefetch_related('structure__images'))
+
+        # Fetch the busy dates of every room on Google Calendar with batched freebusy queries in the background,
+        # while the rooms with conflicting local reservations are looked up on the request thread.
+        # The worker thread uses its own service, a service can't be shared between threads
+        busy_dates_future = availability_executor.submit(run_with_google_calendar_service, get_busy_dates_for_rooms,
+                                                         rooms, check_in, check_out)
+
+        # Paid reservations and unpaid ones younger than 10 minutes hold the room, canceled ones don't
+        current_time = timezone.now()
+        conflicting_room_ids = set(Reservation.objects.filter(
+            Q(room__in=rooms) &
+            Q(period__overlap=(check_in.date(), check_out.date())) &
             (
-                Q(reservations__status=PAID) |
-                Q(reservations__status=UNPAID, reservations__created_at__gte=current_time - timedelta(minutes=10)) |
-                Q(reservations__status=CANCELED)
+                Q(status=PAID) |
+                Q(status=UNPAID, created_at__gte=current_time - timedelta(minutes=10))
             )
-        ).select_related('structure').distinct()
+        ).values_list('room_id', flat=True))
+        available_rooms = [room for room in rooms if room.id not in conflicting_room_ids]
 
-        final_available_rooms = []
+        try:
+            busy_dates_by_room = busy_dates_future.result()
+        except Exception as e:
+            logger.error(f"Error checking availability on Google Calendars: {str(e)}")
+            return Response({'error': 'Error checking room availability.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Check availability for each room with local reservations and Google Calendars
+        final_available_rooms = []
         for room in available_rooms:
-            try:
-                # Get combined busy dates from reservations and both Google Calendars
-                busy_dates = get_combined_busy_dates(room, check_in, check_out, service)
+            if not is_room_available(busy_dates_by_room[room.id], check_in, check_out):
+                logger.info(
+                    f"Room {room.id} is not available for dates {check_in} to {check_out}"
+                )
+                continue
 
-                # Check if the room is available
-                is_available = is_room_available(busy_dates, check_in, check_out)
+            final_available_rooms.append(room)
 
-                if not is_available:
-                    logger.info(
-                        f"Room {room.id} is not available for dates {check_in} to {check_out}"
-                    )
-                    continue
+        # The structure images are prefetched, so serializing the rooms doesn't query them room by room
+        serializer = self.serializer_class(final_available_rooms, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
-                final_available_rooms.append(self.serializer_class(room).data)
 
-            except Exception as e:
-                logger.error(f"Error checking availability for room {room.name}: {str(e)}")
-                return Response({'error': 'Error checking room availability.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+class RoomBusyIntervalsAPI(APIView):
+    """
+    API to get the busy intervals of a room between two dates.
+    Open to everyone, so the requests are throttled and the range of dates is bounded.
+    """
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = 'availability'
 
-        return Response(final_available_rooms, status=status.HTTP_200_OK)
+    @staticmethod
+    def get_object(pk):
+        """
+        Get the room object by primary key
+        """
+        return Room.objects.filter(pk=pk).first()
+
+    def get(self, request, pk):
+        """
+        Get the busy intervals of a room, consecutive busy days are grouped in {start, end} intervals
+        with the end excluded, instead of listing every day
+        """
+        check_in_date = request.query_params.get('check_in')
+        check_out_date = request.query_params.get('check_out')
+
+        if not check_in_date or not check_out_date:
+            return Response({'error': 'Both check_in and check_out dates are required.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            check_in = datetime.combine(date.fromisoformat(check_in_date), time.min, tzinfo=dt_timezone.utc)
+            check_out = datetime.combine(date.fromisoformat(check_out_date), time.min, tzinfo=dt_timezone.utc)
+        except ValueError:
+            return Response({'error': 'Invalid date format. Use YYYY-MM-DD for dates.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if check_in >= check_out:
+            return Response({'error': 'Check-in date must be before check-out date.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if (check_out - check_in).days > MAX_AVAILABILITY_RANGE_DAYS:
+            return Response({'error': f'The dates can be at most {MAX_AVAILABILITY_RANGE_DAYS} days apart.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        room = self.get_object(pk)
+        if room is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            service = get_google_calendar_service()
+            busy_dates = get_combined_busy_dates(room, check_in, check_out, service)
+        except Exception as e:
+            logger.error(f"Error checking availability for room {room.name}: {str(e)}")
+            return Response({'error': 'Error checking room availability.'},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Keep only the busy days inside the requested range
+        requested_days = get_date_range(check_in.date(), check_out.date() - timedelta(days=1))
+        busy_intervals = busy_dates_to_intervals(busy_dates.intersection(requested_days))
+
+        return Response({'room': room.id, 'busy_intervals': busy_intervals}, status=status.HTTP_200_OK)
 
 
 class RentRoomAPI(APIView):
@@ -967,58 +1162,89 @@ class RentRoomAPI(APIView):
         check_out_date = serializer.validated_data['check_out']
 
         # Convert check_in and check_out to datetime with time 00:00 and then to UTC
-        check_in = datetime.combine(check_in_date, datetime.min.time()).replace(tzinfo=pytz.UTC)
-        check_out = datetime.combine(check_out_date, datetime.min.time()).replace(tzinfo=pytz.UTC)
+        check_in = datetime.combine(check_in_date, time.min, tzinfo=dt_timezone.utc)
+        check_out = datetime.combine(check_out_date, time.min, tzinfo=dt_timezone.utc)
 
-        # Update unpaid reservations that have passed the 10-minute timeout to CANCELED
-        unpaid_timeout = timezone.now() - timedelta(minutes=10)
-        Reservation.objects.filter(
-            room=room,
-            status=UNPAID,
-            created_at__lt=unpaid_timeout
-        ).update(status=CANCELED)
+        # Start the Google Calendars check in the background, it only needs the network and the cache,
+        # while the local database is checked on the request thread
+        try:
+            get_google_calendar_credentials()
+        except Exception as e:
+            logger.error(f"Error checking Google Calendar availability: {str(e)}")
+            return Response({'error': 'Error checking room availability on Google Calendar.'},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # The calendars are read without the cache, a booking.com reservation must be seen before booking the room
+        busy_dates_future = booking_executor.submit(run_with_google_calendar_service, get_busy_dates_from_calendars,
+                                                    room, check_in, check_out)
 
-        # Check if the room is available in the local database
+        # Resolve the image shown on the checkout page before taking the room lock
+        image_url = CreateCheckoutSessionLinkAPI.get_structure_image_url(request, room.structure)
+
+        # Check if the room is available in the local database while the calendars are read,
+        # the unpaid reservations that have passed the 10-minute timeout don't hold the room
+        unpaid_timeout = timezone.now() - timedelta(minutes=10)
         conflicting_reservations = Reservation.objects.filter(
             room=room,
-            check_in__lt=check_out,
-            check_out__gt=check_in
-        ).exclude(status=CANCELED)
+            period__overlap=(check_in_date, check_out_date)
+        ).exclude(status=CANCELED).exclude(status=UNPAID, created_at__lt=unpaid_timeout)
 
         if conflicting_reservations.exists():
+            # The calendars don't need to be read anymore, free the worker if the query hasn't started
+            busy_dates_future.cancel()
             logger.info(f"Room {room.id} is not available in local database for dates {check_in} to {check_out}")
             return Response({'error': 'Room is not available for the selected dates.'},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        # Check room availability on both Google Calendars
+        # Check room availability on both Google Calendars before taking the room lock,
+        # so a slow or stalled call to Google doesn't hold up the other bookings of the room
         try:
-            service = get_google_calendar_service()
-            if not service:
-                logger.error("Google Calendar service unavailable.")
-                return Response({'error': 'Google Calendar service unavailable.'},
-                                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-            busy_dates = get_busy_dates_from_calendars(service, room, check_in, check_out)
-            is_available = is_room_available(busy_dates, check_in, check_out)
-
-            if not is_available:
-                logger.info(f"Room {room.id} is not available on Google Calendars for dates {check_in} to {check_out}")
-                return Response({
-                    'error': 'Room is not available for the selected dates due to existing Google Calendar events.'
-                }, status=status.HTTP_400_BAD_REQUEST)
-
+            busy_dates = busy_dates_future.result(timeout=BOOKING_CALENDAR_TIMEOUT)
         except Exception as e:
-            logger.error(f"Error checking Google Calendar availability: {str(e)}")
+            busy_dates_future.cancel()
+            logger.error(f"Error checking Google Calendar availability: {str(e) or type(e).__name__}")
             return Response({'error': 'Error checking room availability on Google Calendar.'},
                             status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # If the room is available, create the reservation
-        reservation = Reservation(**serializer.validated_data)
-        reservation.user = user
+        if not is_room_available(busy_dates, check_in, check_out):
+            logger.info(f"Room {room.id} is not available on Google Calendars for dates {check_in} to {check_out}")
+            return Response({
+                'error': 'Room is not available for the selected dates due to existing Google Calendar events.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with transaction.atomic():
+                # Lock the room so concurrent requests for it are serialized until the reservation is saved
+                Room.objects.select_for_update().get(id=room.id)
+
+                # Update unpaid reservations that have passed the 10-minute timeout to CANCELED,
+                # the exclusion constraint only ignores the canceled ones
+                Reservation.objects.filter(
+                    room=room,
+                    status=UNPAID,
+                    created_at__lt=unpaid_timeout
+                ).update(status=CANCELED)
+
+                # Check again the local database, a reservation may have been saved while the calendars were read
+                if conflicting_reservations.exists():
+                    logger.info(f"Room {room.id} is not available in local database for dates {check_in} to {check_out}")
+                    return Response({'error': 'Room is not available for the selected dates.'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+
+                # If the room is available, create the reservation
+                reservation = Reservation(**serializer.validated_data)
+                reservation.user = user
 
-        # Calculate the total cost of the reservation
-        calculate_total_cost(reservation)
-        reservation.save()
+                reservation.cached_line_items = build_line_items(room, image_url)
+
+                # Calculate the total cost of the reservation
+                calculate_total_cost(reservation)
+
+        except IntegrityError:
+            # The exclusion constraint rejected an overlapping reservation saved concurrently
+            logger.info(f"Room {room.id} was booked concurrently for dates {check_in} to {check_out}")
+            return Response({'error': 'Room is not available for the selected dates.'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
         logger.info(f"Reservation {reservation.id} created by user {user.id}")
 
@@ -1043,30 +1269,31 @@ class CalculateDiscountAPI(APIView):
             discount_code = serializer.validated_data['discount_code']
             reservation_id = serializer.validated_data['reservation']
 
-            try:
-                reservation = Reservation.objects.get(reservation_id__exact=reservation_id)
+            reservation = Reservation.objects.filter(reservation_id=reservation_id).first()
+            if reservation is None:
+                return Response({'error': 'Reservation not found'}, status=status.HTTP_400_BAD_REQUEST)
 
-                if reservation.status == PAID:
-                    return Response({'error': 'This reservation has already been paid.'},
-                                    status=status.HTTP_400_BAD_REQUEST)
+            if reservation.status == PAID:
+                return Response({'error': 'This reservation has already been paid.'},
+                                status=status.HTTP_400_BAD_REQUEST)
 
-                reservation.coupon_used = discount_code
-                reservation.save()
-                discount_amount = calculate_discount(reservation)
-
-                if discount_amount is not None:
-                    return Response({
-                        'total_cost': str(reservation.total_cost),
-                        'discount_amount': str(discount_amount)
-                    }, status=status.HTTP_200_OK)
-                else:
-                    return Response({'error': 'Discount not valid or not applicable for the reservation dates'},
-                                    status=status.HTTP_400_BAD_REQUEST)
+            discount = Discount.objects.filter(code=discount_code).first()
+            if discount is None:
+                return Response({'error': 'Discount code not found'}, status=status.HTTP_404_NOT_FOUND)
 
-            except Reservation.DoesNotExist:
-                return Response({'error': 'Reservation not found'}, status=status.HTTP_400_BAD_REQUEST)
-            except Discount.DoesNotExist:
-                return Response({'error': 'Discount code not found'}, status=status.HTTP_400_BAD_REQUEST)
+            reservation.coupon_used = discount_code
+            discount_amount = calculate_discount(reservation, discount=discount)
+
+            if discount_amount is not None:
+                return Response({
+                    'total_cost': str(reservation.total_cost),
+                    'discount_amount': str(discount_amount)
+                }, status=status.HTTP_200_OK)
+            else:
+                # The coupon is kept on the reservation even when it doesn't apply
+                reservation.save(update_fields=['coupon_used'])
+                return Response({'error': 'Discount not valid or not applicable for the reservation dates'},
+                                status=status.HTTP_400_BAD_REQUEST)
 
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -1074,9 +1301,12 @@ class CalculateDiscountAPI(APIView):
 
 class CreateCheckoutSessionLinkAPI(APIView):
     """
-    API to create a checkout session link for a reservation payment using Stripe
+    API to create a checkout session link for a reservation payment using Stripe.
+    Each user is throttled, so repeated clicks and scripted retries don't all reach Stripe
     """
     permission_classes = [IsAuthenticated]
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = 'checkout'
     serializer_class = CreateCheckoutSessionSerializer
 
     @method_decorator(is_active)
@@ -1087,60 +1317,55 @@ class CreateCheckoutSessionLinkAPI(APIView):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             try:
+                # Read the reservation, the lock is taken later so that it isn't held during the Stripe round trip
+                reservation = Reservation.objects.get(
+                    reservation_id=serializer.validated_data['reservation_id']
+                )
+                if not self.is_payable(reservation):
+                    return Response({'error': 'This reservation cannot be processed for payment.'},
+                                    status=status.HTTP_400_BAD_REQUEST)
 
-                # Get the reservation instance from the validated data
-                reservation = serializer.get_reservation()
+                # Reuse the line items built when the reservation was created and add the amount,
+                # which may have changed since then because of a discount
+                total_cost = reservation.total_cost
+                line_items = reservation.cached_line_items or build_line_items(
+                    reservation.room, self.get_structure_image_url(request, reservation.room.structure)
+                )
+                line_items = [
+                    {**item, 'price_data': {**item['price_data'], 'unit_amount': int(total_cost * 100)}}
+                    for item in line_items
+                ]
+
+                # Create the Checkout Session in the background while the reservation is locked.
+                # A double submit for the same amount gets the session of the first request back from Stripe
+                session_future = checkout_executor.submit(
+                    stripe.checkout.Session.create,
+                    payment_method_types=['card'],
+                    line_items=line_items,
+                    mode='payment',
+                    success_url='https://gm-apartments.it/booking/payment-success',
+                    cancel_url='https://gm-apartments.it/booking/payment-failed',
+                    idempotency_key=CHECKOUT_SESSION_IDEMPOTENCY_KEY.format(
+                        reservation_id=reservation.reservation_id, amount=int(total_cost * 100)
+                    ),
+                )
 
                 with transaction.atomic():
-                    # Lock the reservation for payment processing
-                    reservation = Reservation.objects.select_for_update().get(id=reservation.id)
-
-                    # Retrieve room, structure, and number of people from the reservation
-                    room = reservation.room
-                    structure = room.structure
-                    total_cost = reservation.total_cost
-
-                    # Check if structure has images and get the first one, otherwise use a placeholder
-                    structure_image = structure.images.first()
-                    if structure_image:
-                        image_url = request.build_absolute_uri(structure_image.image.url)
-                    else:
-                        image_url = "https://gmapartments-bucket1.s3.eu-south-1.amazonaws.com/logos/gm-logo-cover.png"
-
-                    # Define line_items according to Stripe's best practices
-                    line_items = [
-                        {
-                            'price_data': {
-                                'currency': 'eur',
-                                'product_data': {
-                                    'name': f'{room.name} at {structure.name}',
-                                    'images': [image_url],
-                                },
-                                'unit_amount': int(total_cost * 100),
-                            },
-                            'quantity': 1,
-                        },
-                    ]
-
-                    # Check if the reservation is already in a state that disallows payment
-                    # (e.g. already paid or canceled or it passed 10 minutes since the reservation was made)
-                    time_elapsed = timezone.now() - reservation.created_at
-                    if reservation.status in [PAID, CANCELED] or time_elapsed > timedelta(minutes=10):
+                    # Lock the reservation for payment processing and check it didn't change in the meantime,
+                    # only the columns checked here are read again
+                    locked_reservation = Reservation.objects.select_for_update().only(
+                        'id', 'status', 'created_at', 'total_cost'
+                    ).get(id=reservation.id)
+                    session = session_future.result()
+
+                    if not self.is_payable(locked_reservation) or locked_reservation.total_cost != total_cost:
+                        self.expire_session(session)
                         return Response({'error': 'This reservation cannot be processed for payment.'},
                                         status=status.HTTP_400_BAD_REQUEST)
 
-                    # Create a new Checkout Session for the order
-                    session = stripe.checkout.Session.create(
-                        payment_method_types=['card'],
-                        line_items=line_items,
-                        mode='payment',
-                        success_url='https://gm-apartments.it/booking/payment-success',
-                        cancel_url='https://gm-apartments.it/booking/payment-failed',
-                    )
-
                     # Add the session ID to the reservation temporarily
-                    reservation.payment_intent_id = session.id
-                    reservation.save()
+                    locked_reservation.payment_intent_id = session.id
+                    locked_reservation.save(update_fields=['payment_intent_id'])
 
                 return Response({'url': session.url}, status=status.HTTP_200_OK)
 
@@ -1148,6 +1373,35 @@ class CreateCheckoutSessionLinkAPI(APIView):
                 return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @staticmethod
+    def is_payable(reservation):
+        """
+        Check that the reservation is not already paid or canceled and that
+        it was made less than 10 minutes ago
+        """
+        time_elapsed = timezone.now() - reservation.created_at
+        return reservation.status not in [PAID, CANCELED] and time_elapsed <= timedelta(minutes=10)
+
+    @staticmethod
+    def get_structure_image_url(request, structure):
+        """
+        Return the URL of the first image of the structure, or a placeholder if it has none
+        """
+        structure_image = structure.images.first()
+        if structure_image:
+            return request.build_absolute_uri(structure_image.image.url)
+        return "https://gmapartments-bucket1.s3.eu-south-1.amazonaws.com/logos/gm-logo-cover.png"
+
+    @staticmethod
+    def expire_session(session):
+        """
+        Expire a checkout session that can't be used for the reservation anymore
+        """
+        try:
+            stripe.checkout.Session.expire(session.id)
+        except stripe.error.StripeError as e:
+            logger.warning(f"Error expiring checkout session {session.id}: {str(e)}")
+
 
 class CancelReservationAPI(APIView):
     """
@@ -1169,21 +1423,35 @@ class CancelReservationAPI(APIView):
         reservation_id = serializer.validated_data['reservation_id']
 
         try:
+            # Only the fields checked here are read, the task loads the full reservation when it cancels it
+            reservations = Reservation.objects.only('id', 'payment_intent_id', 'status', 'event_id')
+
             # Admins can cancel any reservation, but normal users can only cancel their own reservations
             if request.user.type == ADMIN or request.user.is_superuser:
-                reservation = Reservation.objects.get(reservation_id=reservation_id)
+                reservation = reservations.get(reservation_id=reservation_id)
             else:
-                reservation = Reservation.objects.get(reservation_id=reservation_id, user=request.user)
+                reservation = reservations.get(reservation_id=reservation_id, user=request.user)
 
             if not reservation.payment_intent_id:
                 return Response({'error': 'No payment intent found for this reservation.'},
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            cancel_reservation_and_remove_event(reservation)
+            if reservation.status == CANCELED:
+                return Response({'error': 'This reservation is already canceled.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            if not reservation.event_id:
+                return Response({'error': 'No event_id found for this reservation.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            # The cancellation calls Google Calendar, the mail server and Twilio, so it runs in a Celery task,
+            # the reservation status can be followed through the reservations endpoint
+            task = cancel_reservation.delay(reservation.id)
 
             return Response({
-                'message': 'Reservation canceled and refund processed successfully.',
-            }, status=status.HTTP_200_OK)
+                'message': 'Reservation cancellation accepted.',
+                'task_id': task.id,
+            }, status=status.HTTP_202_ACCEPTED)
 
         except Reservation.DoesNotExist:
             return Response({'error': 'Reservation not found.'}, status=status.HTTP_404_NOT_FOUND)
@@ -1220,10 +1488,10 @@ class SendElencoSchedineAPI(APIView):
                 'token': ('{AlloggiatiService}token', token),
             }
 
-            elenco_subelement = ET.Element('{AlloggiatiService}ElencoSchedine')
+            elenco_subelement = etree.Element('{AlloggiatiService}ElencoSchedine')
             for schedina_data in elenco_schedine:
                 schedina_str = SchedinaSerializer().to_representation(schedina_data)
-                schedina_element = ET.SubElement(elenco_subelement, '{AlloggiatiService}string')
+                schedina_element = etree.SubElement(elenco_subelement, '{AlloggiatiService}string')
                 schedina_element.text = schedina_str
 
             # Add the elenco_subelement directly to the body content
@@ -1251,7 +1519,7 @@ class SendElencoSchedineAPI(APIView):
         except ValidationError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        except ET.ParseError as e:
+        except etree.XMLSyntaxError:
             return Response({"error": "Invalid SOAP response format"}, status=status.HTTP_502_BAD_GATEWAY)
 
         except Exception as e:
@@ -1276,16 +1544,12 @@ class UploadDataDmsPugliaXmlAPI(APIView):
                     # Generate XML content
                     xml_content = generate_dms_puglia_xml(serializer.validated_data, vendor="XXXXX")
 
-                    # Convert XML content to bytes for file-like storage
-                    xml_file = io.BytesIO(xml_content.encode('utf-8'))
-                    xml_file.seek(0)  # Reset the file pointer
-
                     # Create a DmsPugliaXml model instance and save the file
                     dms_instance = DmsPugliaXml(structure_id=serializer.validated_data['structure_id'])
                     filename = f'dms_puglia_movimenti_{datetime.now().strftime("%Y%m%d%H%M%S")}.xml'
 
-                    # Save the file to the model's FileField
-                    dms_instance.xml.save(filename, ContentFile(xml_file.read()), save=True)
+                    # Save the file to the model's FileField, the XML content is already encoded
+                    dms_instance.xml.save(filename, ContentFile(xml_content), save=True)
 
                     # Serialize and return the saved instance
                     dms_serializer = DmsPugliaXmlSerializer(dms_instance)
@@ -1336,10 +1600,7 @@ class DownloadDmsPugliaXmlFileAPI(APIView):
         """
         Get the DmsPugliaXml object by primary
         """
-        try:
-            return DmsPugliaXml.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
+        return DmsPugliaXml.objects.filter(pk=pk).first()
 
     @method_decorator(is_active)
     def get(self, request, pk, *args, **kwargs):
@@ -1396,11 +1657,10 @@ class SendWhatsAppToAllUsersAPI(APIView):
     """
     API View to send a WhatsApp message to all users on the site.
     """
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminType]
     serializer_class = SendWhatsAppToAllUsersSerializer
 
     @method_decorator(is_active)
-    @method_decorator(is_admin)
     def post(self, request):
         """
         Handles POST requests to send a WhatsApp message to all users.
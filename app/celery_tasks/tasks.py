@@ -3,14 +3,66 @@ Write your celery tasks here...
 """
 import logging
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
 from celery import shared_task
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Max
 from django.utils import timezone
 
-from accounts.models import Reservation
-from accounts.functions import send_self_checkin_mail, send_self_checkin_whatsapp_message
+from accounts.constants import CANCELED, UNPAID
+from accounts.models import Reservation, Room
+from accounts.functions import (send_self_checkin_mail, send_self_checkin_whatsapp_message,
+                                send_cancel_reservation_email, send_cancel_reservation_whatsapp_message,
+                                delete_reservation_event, complete_paid_reservation,
+                                get_google_calendar_service,
+                                get_busy_dates_for_rooms, get_busy_dates_refresh_interval,
+                                BUSY_DATES_REFRESH_MONTHS, BUSY_DATES_REFRESH_MARKER_KEY, PROPERTY_TZ)
 
 logger = logging.getLogger(__name__)
 
+# Number of reservations whose self check-in reminders are sent at the same time
+SELF_CHECKIN_REMINDER_WORKERS = 16
+# Number of reservations read from the database and sent at a time
+SELF_CHECKIN_REMINDER_CHUNK_SIZE = 500
+
+
+def send_self_checkin_reminder(reservation):
+    """
+    Send the self check-in email and WhatsApp message of a reservation, run in a worker thread.
+    """
+    try:
+        # Log before sending email
+        logger.info(f"Sending self check-in email to {reservation.email_on_reservation}")
+        send_self_checkin_mail(reservation)
+
+        # Log before sending WhatsApp message
+        logger.info(f"Sending WhatsApp self check-in message to {reservation.phone_on_reservation}")
+        send_self_checkin_whatsapp_message(reservation)
+    finally:
+        # The thread may have opened its own database connection, it is closed whatever CONN_MAX_AGE is,
+        # otherwise each thread of the pool would keep one open
+        connection.close()
+
+
+def send_self_checkin_reminder_chunk(executor, reservations):
+    """
+    Send the self check-in reminders of a chunk of reservations on the executor and wait for them.
+    """
+    futures = {
+        executor.submit(send_self_checkin_reminder, reservation): reservation for reservation in reservations
+    }
+    for future in as_completed(futures):
+        reservation = futures[future]
+        try:
+            future.result()
+            logger.info(f"Successfully sent check-in reminders to {reservation.user.email}")
+        except Exception as e:
+            # Error log if any exception occurs
+            logger.error(f"Error sending self check-in reminder to {reservation.user.email}: {e}")
+
 
 @shared_task
 def send_self_checkin_reminders():
@@ -19,30 +71,145 @@ def send_self_checkin_reminders():
     today = timezone.now().date()
     logger.info(f"Checking for reservations with check-in date: {today}")
 
-    # Verify how many reservations are scheduled for today
-    reservations = Reservation.objects.filter(check_in=today)
-    reservation_count = reservations.count()
-    logger.info(f"Found {reservation_count} reservations for today")
+    # The mail serializes the reservation with its user and room, the WhatsApp message uses the structure.
+    # The rows are streamed in chunks, so only one chunk of reservations is held in memory
+    reservations = Reservation.objects.filter(check_in=today).select_related(
+        'user', 'room__structure'
+    ).prefetch_related('user__groups', 'user__user_permissions', 'room__images')
+
+    # The mails and WhatsApp messages only wait on the network, so they are sent concurrently
+    reservation_count = 0
+    with ThreadPoolExecutor(max_workers=SELF_CHECKIN_REMINDER_WORKERS,
+                            thread_name_prefix='self-checkin-reminders') as executor:
+        chunk = []
+        for reservation in reservations.iterator(chunk_size=SELF_CHECKIN_REMINDER_CHUNK_SIZE):
+            chunk.append(reservation)
+            if len(chunk) == SELF_CHECKIN_REMINDER_CHUNK_SIZE:
+                send_self_checkin_reminder_chunk(executor, chunk)
+                reservation_count += len(chunk)
+                chunk = []
+        send_self_checkin_reminder_chunk(executor, chunk)
+        reservation_count += len(chunk)
 
+    logger.info(f"Found {reservation_count} reservations for today")
     if reservation_count == 0:
         logger.warning("No reservations found for today's date.")
 
-    for reservation in reservations:
-        logger.info(f"Processing reservation for user: {reservation.user.email}")
+    logger.info("Task send_self_checkin_reminders completed")
 
-        try:
-            # Log before sending email
-            logger.info(f"Sending self check-in email to {reservation.email_on_reservation}")
-            send_self_checkin_mail(reservation)
 
-            # Log before sending WhatsApp message
-            logger.info(f"Sending WhatsApp self check-in message to {reservation.phone_on_reservation}")
-            send_self_checkin_whatsapp_message(reservation)
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=8)
+def complete_reservation_payment(reservation_id):
+    """
+    Add a paid reservation to Google Calendar and send the confirmation emails.
+    Runs out of the Stripe webhook so that Stripe gets its answer without waiting for Google and the mail server.
+    The reservation is already paid, so a failure is retried until its dates are blocked on the calendar.
+    """
+    logger.info(f"Task complete_reservation_payment started for reservation {reservation_id}")
 
-            logger.info(f"Successfully sent check-in reminders to {reservation.user.email}")
+    # The room and structure are loaded with it for the Google Calendar event
+    reservation = Reservation.objects.select_related('room__structure').get(id=reservation_id)
+    if reservation.status == CANCELED:
+        logger.warning(f"Reservation {reservation_id} was canceled, it is not added to Google Calendar")
+        return
+    complete_paid_reservation(reservation)
 
-        except Exception as e:
-            # Error log if any exception occurs
-            logger.error(f"Error sending self check-in reminder to {reservation.user.email}: {e}")
+    logger.info(f"Task complete_reservation_payment completed for reservation {reservation_id}")
 
-    logger.info("Task send_self_checkin_reminders completed")
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def cancel_reservation(reservation_id):
+    """
+    Cancel a reservation, then remove its Google Calendar event and notify the guest.
+    The status is committed first, so the reservation isn't locked during the calls to Google, the mail server
+    and Twilio, which run in their own tasks once the cancellation is committed and are retried on their own.
+    """
+    logger.info(f"Task cancel_reservation started for reservation {reservation_id}")
+
+    with transaction.atomic():
+        # Lock the reservation so a concurrent cancellation or payment can't interleave
+        reservation = Reservation.objects.select_for_update().only('id', 'status').get(id=reservation_id)
+
+        if reservation.status == CANCELED:
+            logger.warning(f"Reservation {reservation_id} is already canceled")
+            return
+
+        reservation.status = CANCELED
+        reservation.save(update_fields=['status'])
+
+        transaction.on_commit(lambda: remove_reservation_event.delay(reservation_id))
+        transaction.on_commit(lambda: send_cancel_reservation_notifications.delay(reservation_id))
+
+    logger.info(f"Task cancel_reservation completed for reservation {reservation_id}")
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def remove_reservation_event(reservation_id):
+    """
+    Remove the Google Calendar event of a canceled reservation, an event already removed is skipped.
+    """
+    reservation = Reservation.objects.select_related('room').get(id=reservation_id)
+    if reservation.status != CANCELED:
+        logger.warning(f"Reservation {reservation_id} is not canceled, its event is kept")
+        return
+
+    delete_reservation_event(reservation)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def send_cancel_reservation_notifications(reservation_id):
+    """
+    Send the cancellation email and WhatsApp message of a canceled reservation.
+    """
+    # The email serializes the reservation with its user and room, the WhatsApp message uses the structure
+    reservation = Reservation.objects.select_related('user', 'room__structure').get(id=reservation_id)
+    send_cancel_reservation_email(reservation)
+    send_cancel_reservation_whatsapp_message(reservation)
+
+
+@shared_task
+def cancel_expired_reservations():
+    """
+    Cancel the unpaid reservations that passed the 10-minute payment timeout.
+    They already count as free for the availability checks, cancelling them keeps the unpaid ones few
+    and lets the exclusion constraint accept new reservations for their dates.
+    They have no Google Calendar event yet, so they are updated in a single query.
+    """
+    unpaid_timeout = timezone.now() - timedelta(minutes=10)
+    canceled = Reservation.objects.filter(status=UNPAID, created_at__lt=unpaid_timeout).update(status=CANCELED)
+    if canceled:
+        logger.info(f"Canceled {canceled} expired unpaid reservations")
+
+
+@shared_task
+def refresh_busy_dates_cache():
+    """
+    Refresh in the background the cached busy dates of the rooms that are due.
+    Runs every minute, each room is refreshed with an interval that grows with the time elapsed
+    since its last reservation or calendar change, so busy rooms stay warm and idle ones use little quota.
+    """
+    now = timezone.now()
+    rooms = Room.objects.exclude(
+        calendar_id__isnull=True, calendar_id_booking__isnull=True
+    ).annotate(last_reservation_at=Max('reservations__created_at'))
+
+    due_rooms = []
+    for room in rooms:
+        last_activity_at = max(filter(None, (room.last_calendar_change_at, room.last_reservation_at)), default=None)
+        refresh_interval = get_busy_dates_refresh_interval(last_activity_at, now)
+        # The marker expires when the room is due again
+        if cache.add(BUSY_DATES_REFRESH_MARKER_KEY.format(room_id=room.id), True, refresh_interval):
+            due_rooms.append(room)
+
+    if not due_rooms:
+        logger.debug("No room calendar to refresh")
+        return
+
+    # The current month in the time zone of the structures
+    start = now.astimezone(PROPERTY_TZ).date().replace(day=1)
+    end = start
+    for _ in range(BUSY_DATES_REFRESH_MONTHS):
+        end = (end + timedelta(days=32)).replace(day=1)
+
+    get_busy_dates_for_rooms(get_google_calendar_service(), due_rooms, start, end, use_cache=False)
+    logger.info(f"Busy dates refreshed for {len(due_rooms)} rooms")
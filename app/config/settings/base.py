@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'rest_framework_simplejwt',
@@ -48,6 +49,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    # Right after the security middleware, so the static files are served without running the others
+    "whitenoise.middleware.WhiteNoiseMiddleware",
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,7 +59,6 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
 ]
 ROOT_URLCONF = 'core.urls'
 
@@ -96,6 +98,13 @@ DATABASES = {
         'NAME': config('DB_NAME'),
         'USER': config('DB_USERNAME'),
         'PASSWORD': config('DB_PASSWORD'),
+        # Connections are closed after each request by default: under ASGI (gunicorn with uvicorn workers)
+        # persistent connections are tied to the request threads and pile up instead of being reused.
+        # Reuse them through a pooler such as pgbouncer, DB_CONN_MAX_AGE only suits WSGI and Celery processes
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=0, cast=int),
+        'CONN_HEALTH_CHECKS': True,
+        # Must be True when connecting through pgbouncer in transaction pooling mode
+        'DISABLE_SERVER_SIDE_CURSORS': config('DB_DISABLE_SERVER_SIDE_CURSORS', default=False, cast=bool),
     }
 }
 
@@ -114,6 +123,9 @@ CSRF_TRUSTED_ORIGINS = os.getenv('DJANGO_CSRF_TRUSTED_ORIGINS').split(',')
 
 SERVE_MEDIA = True
 
+# Serve the OpenAPI schema and the Swagger UI, can be turned off where the API docs aren't public
+EXPOSE_SCHEMA = config('EXPOSE_SCHEMA', default=True, cast=bool)
+
 CORS_ALLOWED_ORIGINS = os.getenv('DJANGO_CORS_ALLOWED_ORIGINS').split(',')
 
 CORS_ALLOW_CREDENTIALS = True
@@ -148,6 +160,11 @@ REST_FRAMEWORK = {
         # 'rest_framework.authentication.TokenAuthentication',
     ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    # Rates of the views with a throttle_scope, counted in the default cache (Redis)
+    'DEFAULT_THROTTLE_RATES': {
+        'checkout': '10/min',
+        'availability': '60/min',
+    },
 }
 
 SIMPLE_JWT = {
@@ -268,6 +285,9 @@ LANGUAGE_CODE = 'en-us'
 
 TIME_ZONE = 'UTC'
 
+# Time zone of the structures, the days of the Google Calendar bookings are the days of this time zone
+PROPERTY_TIME_ZONE = 'Europe/Rome'
+
 USE_I18N = True
 
 USE_TZ = True
@@ -1,6 +1,5 @@
 from celery.schedules import crontab
 from decouple import config
-from google.auth.environment_vars import AWS_DEFAULT_REGION
 
 from .base import *
 
@@ -8,12 +7,28 @@ from .base import *
 # Celery
 CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://redis:6379/0')
 CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://redis:6379/0')
+# Keep the pooled Redis connections of the broker and result backend alive between tasks,
+# so an idle connection dropped by the network is noticed and replaced before a task needs it
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'socket_keepalive': True,
+    'health_check_interval': 30,
+}
+CELERY_REDIS_SOCKET_KEEPALIVE = True
+CELERY_REDIS_BACKEND_HEALTH_CHECK_INTERVAL = 30
 
 CELERY_BEAT_SCHEDULE = {
     'send_self_checkin_reminders': {
         'task': 'celery_tasks.tasks.send_self_checkin_reminders',
         'schedule': crontab(hour="8", minute="0"),  # Every day at 8 AM
     },
+    'cancel_expired_reservations': {
+        'task': 'celery_tasks.tasks.cancel_expired_reservations',
+        'schedule': crontab(minute="*/5"),  # Every 5 minutes
+    },
+    'refresh_busy_dates_cache': {
+        'task': 'celery_tasks.tasks.refresh_busy_dates_cache',
+        'schedule': crontab(minute="*"),  # Every minute, each room has its own refresh interval
+    },
 }
 CELERY_TIMEZONE = 'Europe/Rome'
 
@@ -23,6 +38,8 @@ AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = config('AWS_STORAGE_BUCKET_NAME')
 AWS_S3_REGION_NAME = config('AWS_S3_REGION_NAME', default='us-east-1')
 AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.{AWS_S3_REGION_NAME}.amazonaws.com'
+# The media names aren't hashed and S3Storage overwrites a file with the same name (e.g. the DMS Puglia XML),
+# so the media files are only cached for a day
 AWS_S3_OBJECT_PARAMETERS = {
     'CacheControl': 'max-age=86400',
 }
@@ -30,6 +47,7 @@ AWS_DEFAULT_ACL = None
 # AWS_QUERYSTRING_AUTH = False
 
 # Media and static files
+SERVE_MEDIA = False
 MEDIA_URL = f'https://{AWS_S3_CUSTOM_DOMAIN}/'
 
 STATIC_URL = 'static/'
@@ -43,3 +61,20 @@ STORAGES = {
         'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
     },
 }
+
+# With a CDN domain (e.g. a CloudFront distribution in front of the bucket) the static files are uploaded
+# to S3 by collectstatic and served by the CDN, so the workers no longer serve them through WhiteNoise
+AWS_STATIC_CUSTOM_DOMAIN = config('AWS_STATIC_CUSTOM_DOMAIN', default='')
+if AWS_STATIC_CUSTOM_DOMAIN:
+    STATIC_URL = f'https://{AWS_STATIC_CUSTOM_DOMAIN}/static/'
+    STORAGES['staticfiles'] = {
+        'BACKEND': 'core.storages.ManifestStaticS3Storage',
+        'OPTIONS': {
+            'bucket_name': config('AWS_STATIC_BUCKET_NAME', default=AWS_STORAGE_BUCKET_NAME),
+            'custom_domain': AWS_STATIC_CUSTOM_DOMAIN,
+            'location': 'static',
+            # The names are hashed, a changed file is a new object, so browsers and the CDN never revalidate them
+            'object_parameters': {'CacheControl': 'public, max-age=31536000, immutable'},
+        },
+    }
+    MIDDLEWARE = [middleware for middleware in MIDDLEWARE if middleware != 'whitenoise.middleware.WhiteNoiseMiddleware']
@@ -0,0 +1,11 @@
+"""
+URL patterns of the OpenAPI schema and of its Swagger UI.
+drf_spectacular.views is only imported by this module, when the patterns are included.
+"""
+from django.urls import path
+from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
+
+urlpatterns = [
+    path('', SpectacularAPIView.as_view(), name='schema'),
+    path('swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
+]
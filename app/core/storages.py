@@ -0,0 +1,12 @@
+"""
+Storage backends used by the settings.
+"""
+from django.contrib.staticfiles.storage import ManifestFilesMixin
+from storages.backends.s3 import S3Storage
+
+
+class ManifestStaticS3Storage(ManifestFilesMixin, S3Storage):
+    """
+    Static files storage on S3 with content-hashed names, like ManifestStaticFilesStorage.
+    A changed file gets a new name, so the CDN in front of the bucket can cache every file forever.
+    """